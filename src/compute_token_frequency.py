@@ -1,16 +1,47 @@
+import hashlib
+import io
 import logging
 import os
 import shutil
 import argparse
 import sys
+import time
 import json
+from itertools import chain
+from multiprocessing import Pool
+import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 from collections import OrderedDict, Counter
 
 from transformers import XLMRobertaTokenizerFast, AutoTokenizer
 
+from sketches import CountMinSketch, HyperLogLog
+from utils import FREQUENCY_VOCAB_FILE, FREQUENCY_VOCAB_ID_SUFFIX, SHARD_SIZE, PrefetchingIterator, get_file_hash, \
+    get_file_shards, open_text_file
+from word_counts import get_word_counts
+
 logging.basicConfig(level=logging.INFO)
 
+BATCH_SIZE = 10000
+# batches of lines read ahead of the tokenizer
+PREFETCH_BATCHES = 4
+# largest line lengths with their own histogram bins
+MAX_TOKENS_PER_LINE = 1024
+MAX_CHARACTERS_PER_LINE = 8192
+# candidate block sizes reported in the line length report
+BLOCK_SIZES = (64, 128, 256, 512)
+# version of the cached counts, increase when TokenCounts changes
+COUNTS_CACHE_VERSION = 9
+# shards of the data resampled by the bootstrap of the tokenizer properties given to the language with the least data
+# by default, and the number of shards of a language below which its confidence intervals are unreliable
+BOOTSTRAP_SHARDS = 100
+MIN_BOOTSTRAP_SHARDS = 20
+# edges of the histogram bins of the batch encoding latencies in seconds, 20 bins per decade
+LATENCY_BIN_EDGES = np.logspace(-5, 3, 161)
+# prefix of the pieces starting a word in SentencePiece vocabularies
+WORD_START_PREFIX = "\u2581"
+
 
 def get_tokenizer_path(tokenizer_dir, tokenizer_type, lang, alpha, NV):
     return os.path.join(tokenizer_dir, tokenizer_type, lang, f"alpha-{alpha}_N-{NV}")
@@ -66,44 +97,825 @@ def batch(iterator, batch_size):
         yield batch
 
 
-def compute_frequencies(data_list, tokenizer, name="token_frequencies", pretokenized=False, output_path=None):
-    """Compute token frequencies for a given tokenizer and data."""
+def get_vocab_size(vocab):
+    """Length of a dense count vector indexed by token id."""
+    return max(vocab.values()) + 1
 
-    # open the train data
-    batch_size = 10000
-    vocab = tokenizer.get_vocab()
-    counter = {token_id: 0 for token_id in vocab.values()}
-    for data_path in data_list:
-        logging.info(f"Reading lines from {data_path}")
-        with open(data_path, "r") as f:
-            # go through the file line by line in batches
+
+def count_token_ids(input_ids, vocab_size):
+    """Count the ids of a tokenized batch into a dense vector of length vocab_size."""
+    flat_ids = np.fromiter(chain.from_iterable(input_ids), dtype=np.int32, count=sum(map(len, input_ids)))
+    return np.bincount(flat_ids, minlength=vocab_size)
+
+
+def tokenize_lines(line_batch, tokenizer):
+    """Token ids of each line. Pretokenized lines are counted with count_pieces instead."""
+    return tokenizer(line_batch)["input_ids"]
+
+
+def index_pieces(piece_lists):
+    """
+    Unique pieces of pretokenized lines (split on whitespace) with their counts, the index of each piece of the
+    concatenated lines into the unique pieces and the number of pieces of each line.
+    """
+    lengths = np.fromiter(map(len, piece_lists), dtype=np.int64, count=len(piece_lists))
+    # counting in a Counter and indexing its keys is faster than np.unique, which sorts the pieces as strings
+    piece_counts = Counter(chain.from_iterable(piece_lists))
+    piece_ids = {piece: i for i, piece in enumerate(piece_counts)}
+    index = np.fromiter(map(piece_ids.__getitem__, chain.from_iterable(piece_lists)), dtype=np.int64,
+                        count=lengths.sum())
+    counts = np.fromiter(piece_counts.values(), dtype=np.int64, count=len(piece_counts))
+    return list(piece_counts), index, counts, lengths
+
+
+def count_pieces(token_counts, pieces, piece_counts, vocab):
+    """Add the counts of unique pretokenized pieces to the token counts, mapping each piece to its id once.
+    Pieces not in the vocabulary are counted in token_counts.unknown_pieces. Returns the id of each piece (-1 if
+    unknown)."""
+    ids = np.fromiter((vocab.get(piece, -1) for piece in pieces), dtype=np.int64, count=len(pieces))
+    counts = np.asarray(piece_counts, dtype=np.int64)
+    known = ids >= 0
+    token_counts.counts += np.bincount(ids[known], weights=counts[known],
+                                       minlength=len(token_counts.counts)).astype(np.int64)
+    for i in np.flatnonzero(~known):
+        token_counts.unknown_pieces[pieces[i]] += int(counts[i])
+    return ids
+
+
+def get_word_start_mask(vocab, vocab_size):
+    """Mask of the token ids starting a word (pieces with the SentencePiece word boundary prefix).
+    Has an extra False entry at the end, for the id -1 of unknown pieces."""
+    word_start = np.zeros(vocab_size + 1, dtype=bool)
+    word_start[[token_id for token, token_id in vocab.items() if token.startswith(WORD_START_PREFIX)]] = True
+    return word_start
+
+
+def count_continued_words(flat_ids, lengths, word_start, special, weights=None):
+    """Number of words split into more than one token in tokenized lines (concatenated flat_ids of the given
+    lengths), i.e. word-starting tokens followed by a non-special token that doesn't start a word in the same line.
+    Each line is counted weights times. Ids of -1 (unknown pieces) are treated as tokens continuing a word."""
+    if len(flat_ids) < 2:
+        return 0
+    starts = word_start[flat_ids]
+    continued = starts[:-1] & ~starts[1:] & ~special[flat_ids[1:]]
+    # the last token of a line is not continued by the next line
+    line_ends = np.cumsum(lengths)[:-1] - 1
+    continued[line_ends[(line_ends >= 0) & (line_ends < len(continued))]] = False
+    if weights is None:
+        return int(continued.sum())
+    return int(np.repeat(weights, lengths)[:-1] @ continued)
+
+
+def get_bigram_keys(flat_ids, lengths, vocab_size, special_ids=()):
+    """Keys (first id * vocab_size + second id) of the adjacent token pairs within the lines of a batch
+    (concatenated flat_ids of the given lengths). Pairs with special tokens are skipped, and so are pairs with
+    unknown pieces (id -1), i.e. the lines are split at the unknown pieces."""
+    if len(flat_ids) < 2:
+        return np.zeros(0, dtype=np.int64)
+    # a pair is valid if both tokens are in the same line and neither of them is special
+    valid = np.ones(len(flat_ids) - 1, dtype=bool)
+    line_ends = np.cumsum(lengths)[:-1] - 1
+    valid[line_ends[(line_ends >= 0) & (line_ends < len(valid))]] = False
+    is_special = np.isin(flat_ids, list(special_ids))
+    valid &= ~is_special[:-1] & ~is_special[1:]
+    # the neighbours of an unknown piece are not adjacent
+    valid &= (flat_ids[:-1] >= 0) & (flat_ids[1:] >= 0)
+    return (flat_ids[:-1] * vocab_size + flat_ids[1:])[valid]
+
+
+class TokenCounts:
+    """Dense token id counts together with the number of lines and characters they were counted from,
+    histograms of the line lengths, optionally HyperLogLog sketches of the distinct words and characters,
+    a count-min sketch of the token bigrams and the counts of each bootstrap shard of the data."""
+
+    # summed when merging and saved in the cache
+    ARRAYS = ("counts", "token_length_histogram", "character_length_histogram", "latency_histogram")
+    SCALARS = ("number_of_lines", "number_of_characters", "continued_words", "encoding_seconds")
+    # merged as the union when merging and saved in the cache, if counted
+    DISTINCT_SKETCHES = ("word_sketch", "character_sketch")
+
+    def __init__(self, vocab_size, bigrams=False, distinct=False):
+        self.counts = np.zeros(vocab_size, dtype=np.int64)
+        self.number_of_lines = 0
+        self.number_of_characters = 0
+        # words split into more than one token
+        self.continued_words = 0
+        # time spent in the tokenizer and the histogram of the latencies of encoding a batch
+        self.encoding_seconds = 0.
+        self.latency_histogram = np.zeros(len(LATENCY_BIN_EDGES) + 1, dtype=np.int64)
+        # lengths of the non-blank lines, the last bin counts all the longer lines
+        self.token_length_histogram = np.zeros(MAX_TOKENS_PER_LINE + 1, dtype=np.int64)
+        self.character_length_histogram = np.zeros(MAX_CHARACTERS_PER_LINE + 1, dtype=np.int64)
+        # distinct whitespace-separated words and distinct (non-whitespace) characters
+        self.word_sketch = HyperLogLog() if distinct else None
+        self.character_sketch = HyperLogLog() if distinct else None
+        self.bigram_sketch = CountMinSketch() if bigrams else None
+        # occurrences of the pretokenized pieces not in the vocabulary
+        self.unknown_pieces = Counter()
+        # sparse (shards x vocab) count blocks and the characters of each shard, if counted by shards
+        self.shard_counts = []
+        self.shard_characters = []
+
+    def __iadd__(self, other):
+        for field in self.ARRAYS:
+            getattr(self, field).__iadd__(getattr(other, field))
+        for field in self.SCALARS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        if self.word_sketch is not None:
+            for field in self.DISTINCT_SKETCHES:
+                getattr(self, field).__iadd__(getattr(other, field))
+        if self.bigram_sketch is not None:
+            self.bigram_sketch += other.bigram_sketch
+        self.unknown_pieces.update(other.unknown_pieces)
+        self.shard_counts += other.shard_counts
+        self.shard_characters += other.shard_characters
+        return self
+
+    def add_latency(self, seconds):
+        """Record the time of encoding a batch."""
+        self.encoding_seconds += seconds
+        self.latency_histogram[np.searchsorted(LATENCY_BIN_EDGES, seconds)] += 1
+
+    def add_shard(self, counts, number_of_characters, extend_last=False):
+        """Record the counts of a finished bootstrap shard, or add them to the last shard if extend_last."""
+        if extend_last and self.shard_counts:
+            self.shard_counts[-1] = self.shard_counts[-1] + sparse.csr_matrix(counts[None, :])
+            self.shard_characters[-1] = self.shard_characters[-1] + number_of_characters
+            return
+        self.shard_counts.append(sparse.csr_matrix(counts[None, :]))
+        self.shard_characters.append(np.array([number_of_characters], dtype=np.int64))
+
+    def get_shards(self):
+        """Sparse (shards x vocab) counts and the (shards) numbers of characters of the bootstrap shards."""
+        if not self.shard_counts:
+            return sparse.csr_matrix((0, len(self.counts)), dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return sparse.vstack(self.shard_counts).tocsr(), np.concatenate(self.shard_characters)
+
+    def save(self, path):
+        arrays = {field: getattr(self, field) for field in self.ARRAYS + self.SCALARS}
+        if self.word_sketch is not None:
+            arrays.update({field: getattr(self, field).registers for field in self.DISTINCT_SKETCHES})
+        if self.bigram_sketch is not None:
+            arrays.update(bigram_table=self.bigram_sketch.table, bigram_candidates=self.bigram_sketch.candidates,
+                          bigram_total=self.bigram_sketch.total)
+        if self.unknown_pieces:
+            # pieces don't contain whitespace, so they are stored as a single newline-separated utf-8 blob
+            arrays.update(
+                unknown_pieces=np.frombuffer("\n".join(self.unknown_pieces).encode("utf-8"), dtype=np.uint8),
+                unknown_piece_counts=np.array(list(self.unknown_pieces.values()), dtype=np.int64))
+        if self.shard_counts:
+            shard_counts, shard_characters = self.get_shards()
+            arrays.update(shard_data=shard_counts.data, shard_indices=shard_counts.indices,
+                          shard_indptr=shard_counts.indptr, shard_characters=shard_characters)
+        # write to a temporary file first, so that an interrupted run never leaves a partial cache entry
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as cached:
+            token_counts = cls(len(cached["counts"]), bigrams="bigram_table" in cached,
+                               distinct="word_sketch" in cached)
+            for field in cls.ARRAYS:
+                getattr(token_counts, field).__iadd__(cached[field])
+            for field in cls.SCALARS:
+                setattr(token_counts, field, cached[field].item())
+            if token_counts.word_sketch is not None:
+                for field in cls.DISTINCT_SKETCHES:
+                    setattr(token_counts, field, HyperLogLog.from_registers(cached[field]))
+            if token_counts.bigram_sketch is not None:
+                token_counts.bigram_sketch.table = cached["bigram_table"]
+                token_counts.bigram_sketch.candidates = cached["bigram_candidates"]
+                token_counts.bigram_sketch.total = int(cached["bigram_total"])
+            if "unknown_pieces" in cached:
+                pieces = cached["unknown_pieces"].tobytes().decode("utf-8").split("\n")
+                token_counts.unknown_pieces = Counter(dict(zip(pieces, cached["unknown_piece_counts"].tolist())))
+            if "shard_data" in cached:
+                token_counts.shard_counts = [sparse.csr_matrix(
+                    (cached["shard_data"], cached["shard_indices"], cached["shard_indptr"]),
+                    shape=(len(cached["shard_characters"]), len(cached["counts"])))]
+                token_counts.shard_characters = [cached["shard_characters"]]
+        return token_counts
+
+
+def count_lines(lines, tokenizer, vocab, pretokenized=False, strip=True, bigrams=False, bootstrap_shard_size=None,
+                distinct=False, batch_size=BATCH_SIZE, progress=False, prefetch_batches=PREFETCH_BATCHES):
+    """Count token ids in an iterable of lines. If strip, trailing whitespace is removed from the lines.
+    If bigrams, adjacent token pairs are counted in a count-min sketch.
+    If distinct, the distinct words and characters are counted in HyperLogLog sketches.
+    If bootstrap_shard_size, the counts of each shard of (at least) that many characters are kept as well. Shards end
+    at the line completing them, the rest of the lines is added to the last shard if shorter than half a shard.
+    The lines are read and batched in a background thread, up to prefetch_batches ahead of the tokenizer."""
+    return count_lines_multi(lines, [tokenizer], [vocab], pretokenized=pretokenized, strip=strip, bigrams=bigrams,
+                             bootstrap_shard_size=bootstrap_shard_size, distinct=distinct, batch_size=batch_size,
+                             progress=progress, prefetch_batches=prefetch_batches)[0]
+
+
+def count_lines_multi(lines, tokenizers, vocabs, pretokenized=False, strip=True, bigrams=False,
+                      bootstrap_shard_size=None, distinct=False, batch_size=BATCH_SIZE, progress=False,
+                      prefetch_batches=PREFETCH_BATCHES):
+    """Count token ids of several tokenizers in an iterable of lines, read only once (see count_lines).
+    Returns a TokenCounts for each tokenizer."""
+    all_token_counts = [TokenCounts(get_vocab_size(vocab), bigrams=bigrams, distinct=distinct) for vocab in vocabs]
+    word_starts = [get_word_start_mask(vocab, get_vocab_size(vocab)) for vocab in vocabs]
+    specials = [np.isin(np.arange(get_vocab_size(vocab) + 1), tokenizer.all_special_ids)
+                for tokenizer, vocab in zip(tokenizers, vocabs)]
+    # the line statistics don't depend on the tokenizer, they are counted once and copied at the end
+    line_counts = all_token_counts[0]
+    # counts at the start of the current bootstrap shard
+    shard_start_counts = [token_counts.counts.copy() for token_counts in all_token_counts]
+    shard_start_characters = 0
+
+    def _finish_shard(extend_last=False):
+        nonlocal shard_start_characters
+        for token_counts, start_counts in zip(all_token_counts, shard_start_counts):
+            token_counts.add_shard(token_counts.counts - start_counts,
+                                   line_counts.number_of_characters - shard_start_characters, extend_last)
+            start_counts[:] = token_counts.counts
+        shard_start_characters = line_counts.number_of_characters
+
+    def _batch_lines():
+        if not bootstrap_shard_size:
+            for raw_batch in batch(lines, batch_size):
+                yield raw_batch, False
+            return
+        # a batch also ends at the line completing a bootstrap shard, so that shards are cut at line granularity
+        raw_batch, shard_characters = [], 0
+        for line in lines:
+            raw_batch.append(line)
+            shard_characters += len(line)
+            if shard_characters >= bootstrap_shard_size:
+                yield raw_batch, True
+                raw_batch, shard_characters = [], 0
+            elif len(raw_batch) == batch_size:
+                yield raw_batch, False
+                raw_batch = []
+        if raw_batch:
+            yield raw_batch, False
+
+    def _read_batches():
+        for raw_batch, ends_shard in _batch_lines():
             # NOTE: we strip the newline character from the end of each line
             # TODO: maybe we shouldn't do this?
-            for line_batch in tqdm(batch(map(lambda s: s.rstrip(), f), batch_size)):
+            yield raw_batch, [line.rstrip() for line in raw_batch] if strip else raw_batch, ends_shard
+
+    start = time.perf_counter()
+    # go through the lines in batches
+    with PrefetchingIterator(_read_batches(), queue_size=prefetch_batches) as batches:
+        for raw_batch, line_batch, ends_shard in tqdm(batches, disable=not progress):
+            # characters are counted including the newline character
+            line_counts.number_of_lines += len(raw_batch)
+            line_counts.number_of_characters += sum(map(len, raw_batch))
+            # pretokenized lines are split once and the unique pieces are looked up in each vocabulary
+            piece_lists = [line.split() for line in line_batch] if pretokenized or distinct else None
+            if distinct:
+                update_distinct_sketches(line_counts, chain.from_iterable(piece_lists))
+            # blank lines are skipped by LineByLineTextDataset, so they are left out of the length histograms
+            non_blank = [i for i, line in enumerate(line_batch) if line and not line.isspace()]
+            line_counts.character_length_histogram += np.bincount(
+                np.minimum([len(line_batch[i]) for i in non_blank], MAX_CHARACTERS_PER_LINE).astype(np.int64),
+                minlength=MAX_CHARACTERS_PER_LINE + 1)
+            if pretokenized:
+                # the pieces are mapped to the unique pieces once for all the tokenizers
+                pieces, piece_index, piece_counts, lengths = index_pieces(piece_lists)
+            for token_counts, tokenizer, vocab, word_start, special in zip(all_token_counts, tokenizers, vocabs,
+                                                                           word_starts, specials):
+                vocab_size = len(token_counts.counts)
+                encoding_start = time.perf_counter()
                 if pretokenized:
-                    for tokenized_line in line_batch:
-                        for tok in tokenized_line.split():
-                            try:
-                                idx = vocab[tok]
-                                counter[idx] += 1
-                            except KeyError as e:
-                                print(f"Token '{tok}' not in vocabulary. Please ensure the tokenizer matches the "
-                                      f"tokenized data.")
-                                raise e
+                    # the unknown pieces keep their id -1, which splits the lines for the bigrams
+                    flat_ids = count_pieces(token_counts, pieces, piece_counts, vocab)[piece_index]
+                    token_counts.add_latency(time.perf_counter() - encoding_start)
                 else:
-                    for tokenized_line in tokenizer(line_batch)["input_ids"]:
-                        for idx in tokenized_line:
-                            counter[idx] += 1
+                    input_ids = tokenize_lines(line_batch, tokenizer)
+                    token_counts.add_latency(time.perf_counter() - encoding_start)
+                    token_counts.counts += count_token_ids(input_ids, vocab_size)
+                    lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+                    flat_ids = np.fromiter(chain.from_iterable(input_ids), dtype=np.int64, count=lengths.sum())
+                token_counts.continued_words += count_continued_words(flat_ids, lengths, word_start, special)
+                token_counts.token_length_histogram += np.bincount(
+                    np.minimum(lengths[non_blank], MAX_TOKENS_PER_LINE), minlength=MAX_TOKENS_PER_LINE + 1)
+                if bigrams:
+                    token_counts.bigram_sketch.update(
+                        get_bigram_keys(flat_ids, lengths, vocab_size, tokenizer.all_special_ids))
+            if ends_shard:
+                _finish_shard()
+    if bootstrap_shard_size and line_counts.number_of_characters > shard_start_characters:
+        _finish_shard(extend_last=line_counts.number_of_characters - shard_start_characters < bootstrap_shard_size / 2)
+    for token_counts in all_token_counts[1:]:
+        token_counts.number_of_lines = line_counts.number_of_lines
+        token_counts.number_of_characters = line_counts.number_of_characters
+        token_counts.character_length_histogram = line_counts.character_length_histogram.copy()
+        if distinct:
+            token_counts.word_sketch = HyperLogLog.from_registers(line_counts.word_sketch.registers)
+            token_counts.character_sketch = HyperLogLog.from_registers(line_counts.character_sketch.registers)
+    elapsed = time.perf_counter() - start
+    # mostly waiting for input means the run is I/O-bound, a mostly waiting reader means it is tokenizer-bound
+    logging.info(f"Counted {line_counts.number_of_lines} lines with {len(tokenizers)} tokenizer(s) in {elapsed:.1f}s "
+                 f"({line_counts.number_of_characters / max(elapsed, 1e-9) / 1e6:.2f}M characters/s), "
+                 f"waited {batches.wait_time:.1f}s ({batches.wait_time / max(elapsed, 1e-9):.0%}) for input, "
+                 f"reader waited {batches.producer_wait_time:.1f}s for the tokenizer")
+    return all_token_counts
+
+
+def update_distinct_sketches(token_counts, words):
+    """Add the words and their characters to the distinct word and character sketches."""
+    words = set(words)
+    token_counts.word_sketch.update(words)
+    token_counts.character_sketch.update("".join(words))
+
+
+def count_words(word_counts, tokenizer, vocab, pretokenized=False, distinct=False, batch_size=BATCH_SIZE):
+    """
+    Derive token counts from word counts (see word_counts.py): each unique word is tokenized once and its ids are
+    counted as many times as the word occurs, plus the special tokens added to each line.
+    Equal to counting the running text for tokenizers that split on whitespace and collapse whitespace runs
+    (e.g. SentencePiece), with the lines stripped of trailing whitespace.
+    """
+    vocab_size = get_vocab_size(vocab)
+    word_start = get_word_start_mask(vocab, vocab_size)
+    special = np.isin(np.arange(vocab_size + 1), tokenizer.all_special_ids)
+    token_counts = TokenCounts(vocab_size, distinct=distinct)
+    token_counts.number_of_lines = word_counts.number_of_lines
+    token_counts.number_of_characters = word_counts.number_of_characters
+    for start in tqdm(range(0, len(word_counts), batch_size)):
+        word_batch = word_counts.words[start:start + batch_size]
+        if distinct:
+            update_distinct_sketches(token_counts, word_batch)
+        if pretokenized:
+            # each word is a piece
+            count_pieces(token_counts, word_batch, word_counts.counts[start:start + batch_size], vocab)
+            continue
+        input_ids = tokenizer(word_batch, add_special_tokens=False)["input_ids"]
+        lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+        flat_ids = np.fromiter(chain.from_iterable(input_ids), dtype=np.int64, count=lengths.sum())
+        np.add.at(token_counts.counts, flat_ids, np.repeat(word_counts.counts[start:start + batch_size], lengths))
+        token_counts.continued_words += count_continued_words(flat_ids, lengths, word_start, special,
+                                                              weights=word_counts.counts[start:start + batch_size])
+    if not pretokenized:
+        # special tokens (e.g. <s> and </s>) added to every line
+        for special_id in tokenizer("")["input_ids"]:
+            token_counts.counts[special_id] += word_counts.number_of_lines
+    return token_counts
+
+
+# state of the worker processes in the sharded mode
+_worker_tokenizers = []
+_worker_vocabs = []
+_worker_count_kwargs = {}
+
+
+def _init_worker(tokenizers, count_kwargs):
+    global _worker_tokenizers, _worker_vocabs, _worker_count_kwargs
+    _worker_tokenizers = tokenizers
+    _worker_vocabs = [tokenizer.get_vocab() for tokenizer in tokenizers]
+    _worker_count_kwargs = count_kwargs
+
+
+def count_file_shard(data_path, start, end, tokenizers, vocabs, **count_kwargs):
+    """Count a line-aligned byte range of a file (the whole file if end is None) with several tokenizers,
+    see count_lines_multi."""
+    if end is None:
+        with open_text_file(data_path) as f:
+            return count_lines_multi(f, tokenizers, vocabs, **count_kwargs)
+    with open(data_path, "rb") as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    # universal newlines, the same as when the whole file is read in text mode
+    lines = io.StringIO(chunk.decode("utf-8"), newline=None)
+    return count_lines_multi(lines, tokenizers, vocabs, **count_kwargs)
+
+
+def _count_shard(shard):
+    data_path, start, end, tokenizer_indices = shard
+    return data_path, tokenizer_indices, count_file_shard(data_path, start, end,
+                                                          [_worker_tokenizers[k] for k in tokenizer_indices],
+                                                          [_worker_vocabs[k] for k in tokenizer_indices],
+                                                          **_worker_count_kwargs)
+
+
+def get_tokenizer_fingerprint(tokenizer):
+    """Hash of the serialized tokenizer (of the vocabulary for tokenizers that cannot be serialized)."""
+    try:
+        serialized = tokenizer.backend_tokenizer.to_str()
+    except AttributeError:
+        serialized = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def get_cache_path(cache_dir, data_path, tokenizer_fingerprint, count_kwargs):
+    """Path of the cached counts of a data file, keyed by the file content, tokenizer and counting options."""
+    options = "_".join(f"{option}-{value}" for option, value in sorted(count_kwargs.items()))
+    options += f"_v{COUNTS_CACHE_VERSION}"
+    cache_name = f"{get_file_hash(data_path, cache_dir)}_{options}.npz"
+    return os.path.join(cache_dir, tokenizer_fingerprint, cache_name)
+
+
+def count_files(data_list, tokenizer, pretokenized=False, strip=True, bigrams=False, bootstrap_shard_size=None,
+                distinct=False, num_workers=1, shard_size=SHARD_SIZE, cache_dir=None, word_index_dir=None):
+    """Count token ids in each of the (unique) data files. Returns a dictionary from path to TokenCounts.
+
+    With ``num_workers > 1`` the files are split into line-aligned byte shards that are counted in a pool of
+    worker processes. The merged counts are the same as in the serial mode. Bootstrap shards don't span the byte
+    shards, which are counted one by one in the serial mode as well, so they don't depend on the number of workers.
+
+    With ``cache_dir`` the counts of each file are cached as soon as the file is counted, keyed by the file content,
+    the tokenizer and the counting options, and only the files without cached counts are tokenized.
+
+    With ``word_index_dir`` the counts are derived from the word counts of the files (built once and saved in the
+    directory), only the unique words are tokenized. Bigrams and bootstrap shards cannot be counted this way.
+    """
+    return count_files_multi(data_list, [tokenizer], pretokenized=pretokenized, strip=strip, bigrams=bigrams,
+                             bootstrap_shard_size=bootstrap_shard_size, distinct=distinct, num_workers=num_workers,
+                             shard_size=shard_size, cache_dir=cache_dir, word_index_dir=word_index_dir)[0]
+
+
+def count_files_multi(data_list, tokenizers, pretokenized=False, strip=True, bigrams=False, bootstrap_shard_size=None,
+                      distinct=False, num_workers=1, shard_size=SHARD_SIZE, cache_dir=None, word_index_dir=None):
+    """Count token ids of several tokenizers in each of the (unique) data files, reading each file once for all the
+    tokenizers without cached counts (see count_files). Returns a dictionary from path to TokenCounts per tokenizer.
+    """
+    if word_index_dir is not None and bigrams:
+        raise ValueError("Bigrams cannot be counted from the word counts.")
+    if word_index_dir is not None and bootstrap_shard_size:
+        raise ValueError("Bootstrap shards cannot be counted from the word counts.")
+    vocabs = [tokenizer.get_vocab() for tokenizer in tokenizers]
+    count_kwargs = dict(pretokenized=pretokenized, strip=strip, bigrams=bigrams,
+                        bootstrap_shard_size=bootstrap_shard_size, distinct=distinct)
+    data_list = list(dict.fromkeys(data_list))
+    file_counts = [{} for _ in tokenizers]
+    cache_paths = [{} for _ in tokenizers]
+    cache_options = dict(count_kwargs, word_counts=word_index_dir is not None)
+    if bootstrap_shard_size:
+        # the bootstrap shards are cut within the byte shards
+        cache_options["shard_size"] = shard_size
+    if cache_dir is not None:
+        for k, tokenizer in enumerate(tokenizers):
+            tokenizer_fingerprint = get_tokenizer_fingerprint(tokenizer)
+            os.makedirs(os.path.join(cache_dir, tokenizer_fingerprint), exist_ok=True)
+            for data_path in data_list:
+                cache_paths[k][data_path] = get_cache_path(cache_dir, data_path, tokenizer_fingerprint, cache_options)
+                if os.path.exists(cache_paths[k][data_path]):
+                    logging.info(f"Loading cached counts for {data_path} from {cache_paths[k][data_path]}")
+                    file_counts[k][data_path] = TokenCounts.load(cache_paths[k][data_path])
+
+    def _file_counted(k, data_path):
+        if data_path in cache_paths[k]:
+            file_counts[k][data_path].save(cache_paths[k][data_path])
+
+    # tokenizers without (cached) counts of each file
+    missing = {data_path: [k for k in range(len(tokenizers)) if data_path not in file_counts[k]]
+               for data_path in data_list}
+    data_list = [data_path for data_path in data_list if missing[data_path]]
+    if word_index_dir is not None:
+        for data_path in data_list:
+            word_counts = get_word_counts(data_path, word_index_dir, num_workers=num_workers)
+            logging.info(f"Counting tokens of {len(word_counts)} unique words of {data_path}")
+            for k in missing[data_path]:
+                file_counts[k][data_path] = count_words(word_counts, tokenizers[k], vocabs[k],
+                                                        pretokenized=pretokenized, distinct=distinct)
+                _file_counted(k, data_path)
+        return file_counts
+
+    for data_path in data_list:
+        for k in missing[data_path]:
+            file_counts[k][data_path] = TokenCounts(get_vocab_size(vocabs[k]), bigrams=bigrams, distinct=distinct)
+    if num_workers > 1 and data_list:
+        shards = [(data_path, start, end, missing[data_path]) for data_path in data_list
+                  for start, end in get_file_shards(data_path, shard_size)]
+        remaining_shards = Counter(data_path for data_path, _, _, _ in shards)
+        logging.info(f"Counting {len(shards)} shards of {len(data_list)} files with {num_workers} workers")
+        with Pool(num_workers, initializer=_init_worker, initargs=(tokenizers, count_kwargs)) as pool:
+            # merged in the order of the shards, so that the bootstrap shards are in the order of the data
+            for data_path, tokenizer_indices, shard_counts in tqdm(pool.imap(_count_shard, shards),
+                                                                   total=len(shards)):
+                for k, token_counts in zip(tokenizer_indices, shard_counts):
+                    file_counts[k][data_path] += token_counts
+                remaining_shards[data_path] -= 1
+                if remaining_shards[data_path] == 0:
+                    for k in tokenizer_indices:
+                        _file_counted(k, data_path)
+    else:
+        for data_path in data_list:
+            logging.info(f"Reading lines from {data_path}")
+            # bootstrap shards are cut within the same byte shards as with several workers
+            file_shards = get_file_shards(data_path, shard_size) if bootstrap_shard_size else [(0, None)]
+            for start, end in file_shards:
+                all_token_counts = count_file_shard(data_path, start, end, [tokenizers[k] for k in missing[data_path]],
+                                                    [vocabs[k] for k in missing[data_path]], progress=True,
+                                                    **count_kwargs)
+                for k, token_counts in zip(missing[data_path], all_token_counts):
+                    file_counts[k][data_path] += token_counts
+            for k in missing[data_path]:
+                _file_counted(k, data_path)
+    return file_counts
+
+
+def sum_counts(file_counts, data_list, vocab_size, bigrams=False, distinct=False):
+    """Sum the counts of the files in data_list (a file listed twice is counted twice)."""
+    token_counts = TokenCounts(vocab_size, bigrams=bigrams, distinct=distinct)
+    for data_path in data_list:
+        token_counts += file_counts[data_path]
+    return token_counts
+
+
+def compute_frequencies(data_list, tokenizer, name="token_frequencies", pretokenized=False, output_path=None,
+                        num_workers=1, shard_size=SHARD_SIZE, cache_dir=None, top_bigrams=None,
+                        word_index_dir=None, distinct=False):
+    """Compute token frequencies for a given tokenizer and data.
+    If top_bigrams, the most frequent token bigrams are saved as well (`{name}_bigrams.json`).
+    If distinct, the estimated numbers of distinct words and characters are saved as well (`{name}_distinct.json`)."""
+    return compute_frequencies_multi(data_list, [tokenizer], [output_path], name=name, pretokenized=pretokenized,
+                                     num_workers=num_workers, shard_size=shard_size, cache_dir=cache_dir,
+                                     top_bigrams=top_bigrams, word_index_dir=word_index_dir, distinct=distinct)[0]
+
+
+def compute_frequencies_multi(data_list, tokenizers, output_paths, name="token_frequencies", pretokenized=False,
+                              num_workers=1, shard_size=SHARD_SIZE, cache_dir=None, top_bigrams=None,
+                              word_index_dir=None, distinct=False):
+    """Compute token frequencies of several tokenizers on the same data, reading the data once.
+    The frequencies of each tokenizer are saved in the corresponding output path (see compute_frequencies)."""
+    all_file_counts = count_files_multi(data_list, tokenizers, pretokenized=pretokenized, bigrams=bool(top_bigrams),
+                                        distinct=distinct, num_workers=num_workers, shard_size=shard_size, cache_dir=cache_dir,
+                                        word_index_dir=word_index_dir)
+    all_token_counts = []
+    for tokenizer, output_path, file_counts in zip(tokenizers, output_paths, all_file_counts):
+        vocab = tokenizer.get_vocab()
+        token_counts = sum_counts(file_counts, data_list, get_vocab_size(vocab), bigrams=bool(top_bigrams),
+                                  distinct=distinct)
+        save_frequencies(token_counts.counts, vocab, output_path, name)
+        save_length_report(token_counts, output_path, name)
+        if distinct:
+            save_distinct_sketches(token_counts, output_path, name)
+        save_unknown_pieces(token_counts, output_path, name)
+        save_word_statistics(token_counts, vocab, tokenizer.all_special_ids, output_path, name)
+        save_tokenization_profile(token_counts, output_path, name)
+        if top_bigrams:
+            save_bigrams(token_counts.bigram_sketch, vocab, top_bigrams, output_path, name)
+        all_token_counts.append(token_counts)
+    return all_token_counts
 
-    id_to_token = {v: k for k, v in vocab.items()}
-    tokens_with_freq = sorted(counter.items(), key=lambda x: x[1], reverse=True)
-    decoded_tokens_with_freq = [
-        (id_to_token[token_id], freq) for token_id, freq in tokens_with_freq
-    ]
 
+def compute_language_frequencies(lang2data, tokenizer, pretokenized=False, output_path=None, save_all=True,
+                                 num_workers=1, shard_size=SHARD_SIZE, cache_dir=None, top_bigrams=None,
+                                 word_index_dir=None, bootstrap_shard_size=None, distinct=False):
+    """Compute per-language token frequencies (`token_freq_{lang}`) and, if save_all, the frequencies over all
+    the data (`token_frequencies`) in a single pass. Each file is tokenized once.
+    If top_bigrams, the most frequent token bigrams are saved as well.
+    If distinct, the estimated numbers of distinct words and characters are saved as well.
+    If bootstrap_shard_size, the counts of the shards of each language are saved for the bootstrap
+    (`token_freq_{lang}_shards.npz`, see load_bootstrap_shards).
+
+    Returns the number of characters per language (and "All" if save_all).
+    """
+    vocab = tokenizer.get_vocab()
+    vocab_size = get_vocab_size(vocab)
+    data_list = [data_path for data_paths in lang2data.values() for data_path in data_paths]
+    file_counts = count_files(data_list, tokenizer, pretokenized=pretokenized, bigrams=bool(top_bigrams),
+                              bootstrap_shard_size=bootstrap_shard_size, distinct=distinct, num_workers=num_workers,
+                              shard_size=shard_size, cache_dir=cache_dir, word_index_dir=word_index_dir)
+
+    number_of_characters = {}
+    names = {lang: f"token_freq_{lang}" for lang in lang2data}
+    if save_all:
+        names["All"] = "token_frequencies"
+    for lang, name in names.items():
+        token_counts = sum_counts(file_counts, data_list if lang == "All" else lang2data[lang], vocab_size,
+                                  bigrams=bool(top_bigrams), distinct=distinct)
+        save_frequencies(token_counts.counts, vocab, output_path, name)
+        save_length_report(token_counts, output_path, name)
+        if distinct:
+            save_distinct_sketches(token_counts, output_path, name)
+        save_unknown_pieces(token_counts, output_path, name)
+        save_word_statistics(token_counts, vocab, tokenizer.all_special_ids, output_path, name)
+        save_tokenization_profile(token_counts, output_path, name)
+        if top_bigrams:
+            save_bigrams(token_counts.bigram_sketch, vocab, top_bigrams, output_path, name)
+        if bootstrap_shard_size and lang != "All":
+            save_bootstrap_shards(token_counts, output_path, name)
+        number_of_characters[lang] = token_counts.number_of_characters
+    return number_of_characters
+
+
+def save_frequencies(counts, vocab, output_path, name):
+    tokens_with_freq, decoded_tokens_with_freq = sort_frequencies(counts, vocab)
     save_token_frequency(
         tokens_with_freq, decoded_tokens_with_freq, output_path, name
     )
+    save_frequency_array(counts, vocab, output_path, name)
+
+
+def get_length_report(token_counts, block_sizes=BLOCK_SIZES):
+    """
+    Distribution of the tokens and characters per (non-blank) line, and the share of truncated lines, lost tokens
+    and padding when the lines are truncated to `block_size - 2` tokens (as in LineByLineTextDataset) and padded
+    to that length.
+    """
+    def _summary(histogram, max_bin):
+        lengths = np.arange(len(histogram))
+        cumulative = np.cumsum(histogram) / histogram.sum()
+        return {"mean": float(histogram @ lengths / histogram.sum()),
+                **{f"p{q}": int(np.searchsorted(cumulative, q / 100.)) for q in (50, 90, 95, 99)},
+                "max_bin": max_bin,
+                # number of lines of each length, the last bin counts all the longer lines
+                "histogram": np.trim_zeros(histogram, "b").tolist()}
+
+    token_histogram = token_counts.token_length_histogram
+    lengths = np.arange(len(token_histogram))
+    report = {"number_of_lines": int(token_histogram.sum()),
+              "tokens_per_line": _summary(token_histogram, MAX_TOKENS_PER_LINE),
+              "characters_per_line": _summary(token_counts.character_length_histogram, MAX_CHARACTERS_PER_LINE),
+              "block_sizes": {}}
+    for block_size in block_sizes:
+        max_length = block_size - 2
+        kept_tokens = token_histogram @ np.minimum(lengths, max_length)
+        report["block_sizes"][block_size] = {
+            "truncated_lines": float(token_histogram[lengths > max_length].sum() / token_histogram.sum()),
+            # lower bound for lines longer than MAX_TOKENS_PER_LINE
+            "truncated_tokens": float(1. - kept_tokens / (token_histogram @ lengths)),
+            "padding": float(1. - kept_tokens / (max_length * token_histogram.sum())),
+        }
+    return report
+
+
+def get_word_statistics(token_counts, vocab, special_ids):
+    """Number of (non-special) tokens, of words (word-starting tokens) and of words split into more than one token.
+    Words are None if the vocabulary has no word boundary prefix."""
+    vocab_size = len(token_counts.counts)
+    word_start = get_word_start_mask(vocab, vocab_size)[:vocab_size]
+    special = np.isin(np.arange(vocab_size), special_ids)
+    return {"tokens": int(token_counts.counts[~special].sum()),
+            "words": int(token_counts.counts[word_start].sum()) if word_start.any() else None,
+            "continued_words": token_counts.continued_words if word_start.any() else None}
+
+
+def save_word_statistics(token_counts, vocab, special_ids, out_path, name):
+    """Save the token, word and continued word counts used for the fertility (`{name}_words.json`)."""
+    save_path = os.path.join(out_path, f"{name}_words.json")
+    logging.info(f"Writing word statistics to {save_path}")
+    with open(save_path, "w", encoding="utf-8") as outfile:
+        json.dump(get_word_statistics(token_counts, vocab, special_ids), outfile, indent=2)
+
+
+def get_tokenization_profile(token_counts):
+    """Encoding throughput (characters and lines per second spent in the tokenizer) and the median and 99th
+    percentile of the batch encoding latency (upper edges of the latency histogram bins)."""
+    n_batches = int(token_counts.latency_histogram.sum())
+    if n_batches == 0 or token_counts.encoding_seconds == 0:
+        return None
+    cumulative = np.cumsum(token_counts.latency_histogram) / n_batches
+    # the last bin has no upper edge
+    upper_edges = np.append(LATENCY_BIN_EDGES, np.inf)
+    return {"encoding_seconds": token_counts.encoding_seconds,
+            "batches": n_batches,
+            "characters_per_second": token_counts.number_of_characters / token_counts.encoding_seconds,
+            "lines_per_second": token_counts.number_of_lines / token_counts.encoding_seconds,
+            "batch_latency_p50": float(upper_edges[np.searchsorted(cumulative, 0.5)]),
+            "batch_latency_p99": float(upper_edges[np.searchsorted(cumulative, 0.99)])}
+
+
+def save_tokenization_profile(token_counts, out_path, name):
+    """Save the tokenization cost profile (`{name}_profile.json`), if the lines were tokenized."""
+    profile = get_tokenization_profile(token_counts)
+    if profile is None:
+        return
+    save_path = os.path.join(out_path, f"{name}_profile.json")
+    logging.info(f"Writing tokenization profile to {save_path}")
+    with open(save_path, "w", encoding="utf-8") as outfile:
+        json.dump(profile, outfile, indent=2)
+
+
+def save_length_report(token_counts, out_path, name):
+    """Save the line length report (`{name}_lengths.json`), if the line lengths were counted."""
+    if token_counts.token_length_histogram.sum() == 0:
+        logging.warning(f"No line lengths counted for {name} (e.g. counted from word counts), skipping the report.")
+        return
+    save_path = os.path.join(out_path, f"{name}_lengths.json")
+    logging.info(f"Writing line length report to {save_path}")
+    with open(save_path, "w", encoding="utf-8") as outfile:
+        json.dump(get_length_report(token_counts), outfile, indent=2)
+
+
+def save_distinct_sketches(token_counts, out_path, name):
+    """
+    Save the estimated numbers of distinct words and characters (`{name}_distinct.json`) and their sketches
+    (`{name}_distinct.npz`), which can be merged across languages, splits and clusters (see load_distinct_sketches).
+    """
+    save_path = os.path.join(out_path, f"{name}_distinct")
+    logging.info(f"Writing distinct word and character estimates to {save_path}.json")
+    with open(save_path + ".json", "w", encoding="utf-8") as outfile:
+        json.dump({"words": token_counts.word_sketch.estimate(),
+                   "characters": token_counts.character_sketch.estimate(),
+                   "relative_error": token_counts.word_sketch.relative_error}, outfile, indent=2)
+    np.savez(save_path + ".npz", words=token_counts.word_sketch.registers,
+             characters=token_counts.character_sketch.registers)
+
+
+def save_unknown_pieces(token_counts, out_path, name, top_k=1000):
+    """Report the pretokenized pieces not in the vocabulary (`{name}_unknown_pieces.json`), if there are any."""
+    if not token_counts.unknown_pieces:
+        return
+    unknown = sum(token_counts.unknown_pieces.values())
+    save_path = os.path.join(out_path, f"{name}_unknown_pieces.json")
+    logging.warning(f"{unknown} occurrences of {len(token_counts.unknown_pieces)} pieces not in the vocabulary, "
+                    f"please ensure the tokenizer matches the tokenized data. Writing them to {save_path}")
+    with open(save_path, "w", encoding="utf-8") as outfile:
+        json.dump({"occurrences": unknown,
+                   "share_of_tokens": unknown / (unknown + int(token_counts.counts.sum())),
+                   "unique_pieces": len(token_counts.unknown_pieces),
+                   "pieces": dict(token_counts.unknown_pieces.most_common(top_k))},
+                  outfile, indent=2, ensure_ascii=False)
+
+
+def save_bootstrap_shards(token_counts, out_path, name):
+    """Save the sparse counts and the numbers of characters of the bootstrap shards (`{name}_shards.npz`)."""
+    shard_counts, shard_characters = token_counts.get_shards()
+    save_path = os.path.join(out_path, f"{name}_shards.npz")
+    logging.info(f"Writing counts of {len(shard_characters)} bootstrap shards to {save_path}")
+    np.savez(save_path, data=shard_counts.data, indices=shard_counts.indices, indptr=shard_counts.indptr,
+             shape=shard_counts.shape, characters=shard_characters)
+
+
+def load_bootstrap_shards(out_path, name):
+    """Sparse (shards x vocab) counts and (shards) numbers of characters saved by save_bootstrap_shards."""
+    with np.load(os.path.join(out_path, f"{name}_shards.npz")) as saved:
+        return (sparse.csr_matrix((saved["data"], saved["indices"], saved["indptr"]), shape=tuple(saved["shape"])),
+                saved["characters"])
+
+
+def load_distinct_sketches(paths):
+    """Merge the distinct word and character sketches (`{name}_distinct.npz`) of several outputs,
+    returns the (word_sketch, character_sketch) of the union of their data."""
+    word_sketch, character_sketch = None, None
+    for path in paths:
+        with np.load(path) as saved:
+            if word_sketch is None:
+                word_sketch = HyperLogLog.from_registers(saved["words"])
+                character_sketch = HyperLogLog.from_registers(saved["characters"])
+            else:
+                word_sketch += HyperLogLog.from_registers(saved["words"])
+                character_sketch += HyperLogLog.from_registers(saved["characters"])
+    return word_sketch, character_sketch
+
+
+def save_bigrams(bigram_sketch, vocab, k, out_path, name):
+    """Save the k most frequent token bigrams (`{name}_bigrams.json`) with their estimated counts."""
+    id_to_token = {v: k for k, v in vocab.items()}
+    vocab_size = get_vocab_size(vocab)
+    bigrams = []
+    for key, count in bigram_sketch.heavy_hitters(k):
+        first_id, second_id = divmod(key, vocab_size)
+        bigrams.append({"ids": [first_id, second_id], "tokens": [id_to_token[first_id], id_to_token[second_id]],
+                        "count": count})
+    save_path = os.path.join(out_path, f"{name}_bigrams.json")
+    logging.info(f"Writing bigram frequencies to {save_path}")
+    with open(save_path, "w", encoding="utf-8") as outfile:
+        json.dump({"total": bigram_sketch.total,
+                   # estimated counts exceed the true counts by at most this with the probability below
+                   "error_bound": bigram_sketch.error_bound,
+                   "error_probability": float(np.exp(-bigram_sketch.depth)),
+                   "bigrams": bigrams},
+                  outfile, indent=2, ensure_ascii=False)
+
+
+def save_frequency_array(counts, vocab, out_path, name):
+    """
+    Save the dense counts indexed by token id (`{name}.npy`) with the fingerprint of their vocabulary, so that
+    the binary files of different tokenizers can be saved to one directory.
+    """
+    tokens = [None] * len(counts)
+    for token, token_id in vocab.items():
+        tokens[token_id] = token
+    tokens_json = json.dumps(tokens, ensure_ascii=False)
+    fingerprint = hashlib.sha256(tokens_json.encode("utf-8")).hexdigest()[:16]
+    vocab_path = os.path.join(out_path, FREQUENCY_VOCAB_FILE.format(fingerprint=fingerprint))
+    if not os.path.exists(vocab_path):
+        with open(vocab_path + ".tmp", "w", encoding="utf-8") as outfile:
+            outfile.write(tokens_json)
+        os.replace(vocab_path + ".tmp", vocab_path)
+
+    # the fingerprint is written last, the binary counts aren't used without it
+    fingerprint_path = os.path.join(out_path, f"{name}{FREQUENCY_VOCAB_ID_SUFFIX}")
+    if os.path.exists(fingerprint_path):
+        os.remove(fingerprint_path)
+    save_path = os.path.join(out_path, f"{name}.npy")
+    logging.info(f"Writing frequencies to {save_path}")
+    np.save(save_path, counts)
+    with open(fingerprint_path, "w") as outfile:
+        outfile.write(fingerprint)
+
+
+def sort_frequencies(counts, vocab):
+    """Pairs (token id, frequency) and (token, frequency) sorted by decreasing frequency, ties by token id."""
+    id_to_token = {v: k for k, v in vocab.items()}
+    token_ids = np.array(sorted(id_to_token), dtype=np.int64)
+    token_ids = token_ids[np.argsort(-counts[token_ids], kind="stable")]
+    tokens_with_freq = list(zip(token_ids.tolist(), counts[token_ids].tolist()))
+    decoded_tokens_with_freq = [
+        (id_to_token[token_id], freq) for token_id, freq in tokens_with_freq
+    ]
+    return tokens_with_freq, decoded_tokens_with_freq
 
 
 if __name__ == "__main__":
@@ -111,7 +923,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "-d", "--data_list", nargs="+", help="<Required> Set flag", required=True
     )
-    parser.add_argument("-o", "--out_dir", type=str, required=True)
+    parser.add_argument(
+        "-o", "--out_dir", type=str, required=False, default=None,
+        help="Output directory of a single tokenizer (by default the tokenizer directory). With several tokenizer "
+             "paths, use --tokenizer_out_dirs instead."
+    )
     parser.add_argument(
         "-l",
         "--languages",
@@ -122,7 +938,13 @@ if __name__ == "__main__":
     
     # tokenizer parameters
     parser.add_argument(
-        "--tokenizer_path", type=str, required=False, default=None
+        "--tokenizer_path", type=str, nargs="+", required=False, default=None,
+        help="Path(s) of the tokenizer(s). The data is read once for all the tokenizers."
+    )
+    parser.add_argument(
+        "--tokenizer_out_dirs", type=str, nargs="+", required=False, default=None,
+        help="Output directory of each tokenizer, if more than one tokenizer path is given "
+             "(by default the tokenizer directories)."
     )
     parser.add_argument(
         "-a", "--alpha", type=str, required=False, help="Balancing coefficient alpha."
@@ -132,17 +954,55 @@ if __name__ == "__main__":
     parser.add_argument(
         "-n", "--name", type=str, required=False, default="token_frequencies"
     )
+    parser.add_argument(
+        "-w", "--num_workers", type=int, required=False, default=1,
+        help="Number of worker processes counting line-aligned shards of the data files in parallel."
+    )
+    parser.add_argument(
+        "--shard_size", type=int, required=False, default=SHARD_SIZE, help="Size of a shard in bytes."
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, required=False, default=None,
+        help="Directory with cached per-file counts. Only files without cached counts are tokenized."
+    )
+    parser.add_argument(
+        "--word_index_dir", type=str, required=False, default=None,
+        help="Derive the frequencies from per-file word counts saved in this directory (built if missing), "
+             "tokenizing only the unique words. Exact for tokenizers splitting on whitespace (e.g. SentencePiece)."
+    )
+    parser.add_argument(
+        "--top_bigrams", type=int, required=False, default=None,
+        help="Also save this many most frequent token bigrams, counted in a fixed-memory count-min sketch."
+    )
+    parser.add_argument(
+        "--distinct", action="store_true",
+        help="Also save the estimated numbers of distinct words and characters (HyperLogLog sketches)."
+    )
     
     args = parser.parse_args()
     languages_str = "-".join(args.languages)
 
-    # load the tokenizer
-    if not args.tokenizer_path:
-        assert args.alpha is not None and args.vocab_size is not None and type is not None and args.out_dir is not None, (
+    # load the tokenizer(s)
+    tokenizer_paths = args.tokenizer_path
+    if not tokenizer_paths:
+        assert args.alpha is not None and args.vocab_size is not None and args.type is not None and args.out_dir is not None, (
             "If no tokenizer path is provided, alpha, vocab_size, type and out_dir must be provided."
         )
-        tokenizer_path = get_tokenizer_path(args.out_dir, type, languages_str, args.alpha, args.vocab_size)
+        tokenizer_paths = [get_tokenizer_path(args.out_dir, args.type, languages_str, args.alpha, args.vocab_size)]
+
+    if len(tokenizer_paths) == 1:
+        output_paths = [args.out_dir or tokenizer_paths[0]]
+    else:
+        if args.out_dir is not None:
+            parser.error("--out_dir is only used with a single tokenizer, "
+                         "give the output directory of each tokenizer with --tokenizer_out_dirs")
+        output_paths = args.tokenizer_out_dirs or tokenizer_paths
+        assert len(output_paths) == len(tokenizer_paths), "An output directory must be given for each tokenizer."
+    for output_path in output_paths:
+        os.makedirs(output_path, exist_ok=True)
 
-    tokenizer = get_tokenizer(tokenizer_path)
-    compute_frequencies(data_list=args.data_list, tokenizer=tokenizer, name=args.name, pretokenized=False,
-                        output_path=args.out_dir or tokenizer_path)
+    tokenizers = [get_tokenizer(tokenizer_path) for tokenizer_path in tokenizer_paths]
+    compute_frequencies_multi(data_list=args.data_list, tokenizers=tokenizers, output_paths=output_paths,
+                              name=args.name, pretokenized=False, num_workers=args.num_workers,
+                              shard_size=args.shard_size, cache_dir=args.cache_dir, top_bigrams=args.top_bigrams,
+                              word_index_dir=args.word_index_dir, distinct=args.distinct)
@@ -28,67 +28,59 @@ import json
 import os
 from os import path
 import numpy as np
-from scipy.spatial.distance import jensenshannon
+from scipy import sparse
 from transformers import AutoTokenizer
 import logging
 from collections import defaultdict
-from itertools import combinations
+from itertools import chain, combinations
 
-from compute_token_frequency import compute_frequencies, get_tokenizer
-from utils import get_distributions_over_decoded_vocabulary_default
+from compute_token_frequency import BOOTSTRAP_SHARDS, MIN_BOOTSTRAP_SHARDS, TokenCounts, \
+    compute_language_frequencies, count_pieces, get_tokenizer, get_vocab_size, index_pieces, load_bootstrap_shards, \
+    save_unknown_pieces, tokenize_lines
+from notebooks.notebook_utils import compute_jsd_matrix, compute_paired_jsd
+from utils import get_current_rss_mb, get_number_of_characters, get_peak_rss_mb, \
+    get_vocabulary_distributions_default, is_compressed
 
 logging.basicConfig(level=logging.INFO)
 
 UNK_TOKEN = "<unk>"
 
 
-def compute_number_of_characters(lang2data: dict[str, list[str]]) -> dict[str, int]:
+def compute_number_of_characters(lang2data: dict[str, list[str]], cache_dir: str = None) -> dict[str, int]:
     number_of_characters = defaultdict(int)
 
     for lang, data_paths in lang2data.items():
         for data_path in data_paths:
-            with open(data_path, "r") as data_f:
-                for line in data_f:
-                    number_of_characters[lang] += len(line)
-                    number_of_characters["All"] += len(line)
+            data_characters = get_number_of_characters(data_path, cache_dir=cache_dir)
+            number_of_characters[lang] += data_characters
+            number_of_characters["All"] += data_characters
 
     return number_of_characters
 
 
-def compute_jsd(probabilities_l1, probabilities_l2, base=2.):
-    return jensenshannon(probabilities_l1, probabilities_l2, base=base) ** 2
+def get_properties(languages, out_dir, number_of_characters, unk_token=UNK_TOKEN, jsd_matrix_file=None):
+    """Tokenizer properties from the saved token frequencies. If jsd_matrix_file, the JSD matrix of all the
+    languages is saved there as well (npz with `jsd` and `languages`)."""
 
-
-def compute_average_rank(probabilities):
-    sorted_probabilities = np.sort(probabilities)[::-1]
-    r_e = np.sum(sorted_probabilities * np.arange(len(probabilities)))
-    return r_e
-
-
-def get_properties(languages, out_dir, number_of_characters, unk_token=UNK_TOKEN):
-    
-    vocab_distributions, vocab_frequencies = \
-        get_distributions_over_decoded_vocabulary_default(out_dir, languages)
-    
-    languages = list(set(languages)) + ["All"]
-    vocab_distributions_arr = {lang: np.array(list(vocab_distributions[lang].values())) for lang in languages}
+    distributions = get_vocabulary_distributions_default(out_dir, list(dict.fromkeys(languages)))
+    languages = distributions.languages
     properties = {}
     
     # computes Overalp (in JSD)
     logging.info("Computing Overlap (JSD)...")
     properties['JSD'] = {}
-    for lang1, lang2 in combinations(languages, 2):
-        properties['JSD'][f'{lang1}-{lang2}'] = \
-            compute_jsd(vocab_distributions_arr[lang1], vocab_distributions_arr[lang2])
+    jsd_matrix = compute_jsd_matrix(distributions.probabilities)
+    for (i, lang1), (j, lang2) in combinations(enumerate(languages), 2):
+        properties['JSD'][f'{lang1}-{lang2}'] = jsd_matrix[i, j]
+    if jsd_matrix_file is not None:
+        logging.info(f"Saving JSD matrix to {jsd_matrix_file}")
+        np.savez(jsd_matrix_file, jsd=jsd_matrix, languages=np.array(languages))
         
     # computes Vocab Allocation (Average Rank)
     logging.info("Computing Vocab Allocation (Average Rank)...")
-    properties['Average Rank'] = {}
-    for lang in languages:
-        properties['Average Rank'][lang] = \
-            compute_average_rank(vocab_distributions_arr[lang])
+    properties['Average Rank'] = dict(zip(languages, distributions.average_rank()))
             
-    number_of_tokens = {lang: np.sum(list(vocab_frequencies[lang].values())) for lang in languages}
+    number_of_tokens = dict(zip(languages, distributions.number_of_tokens))
     
     # compute (Characters per Token)
     logging.info("Computing Characters per Token...")
@@ -98,14 +90,207 @@ def get_properties(languages, out_dir, number_of_characters, unk_token=UNK_TOKEN
         
     # compute Coverage (percentage of unknown tokens)
     logging.info("Computing Coverage (1 - percentage of unknown tokens)...")
-    properties['Coverage'] = {}
+    coverage = distributions.coverage(unk_token)
+    if coverage is None:
+        logging.warning(f"Unknown token {unk_token} not in vocabulary.")
+    properties['Coverage'] = dict(zip(languages, coverage if coverage is not None else [None] * len(languages)))
+
+    # compute Fertility (tokens per word), Continued Words (share of words split into more than one token) and
+    # Parity (fertility relative to "All") from the word statistics saved in the counting pass
+    logging.info("Computing Fertility, Continued Words and Parity...")
+    word_statistics = load_language_statistics(out_dir, languages, "words")
+    properties['Fertility'], properties['Continued Words'], properties['Parity'] = {}, {}, {}
+    for lang in languages:
+        statistics = word_statistics.get(lang)
+        if not statistics or not statistics["words"]:
+            properties['Fertility'][lang] = properties['Continued Words'][lang] = None
+            continue
+        properties['Fertility'][lang] = statistics["tokens"] / statistics["words"]
+        properties['Continued Words'][lang] = statistics["continued_words"] / statistics["words"]
+    for lang in languages:
+        properties['Parity'][lang] = properties['Fertility'][lang] / properties['Fertility']["All"] \
+            if properties['Fertility'][lang] is not None and properties['Fertility'].get("All") else None
+
+    # tokenization cost, measured in the counting pass
+    logging.info("Collecting the tokenization cost profile...")
+    profiles = load_language_statistics(out_dir, languages, "profile")
+    for metric, key in [('Characters per Second', "characters_per_second"), ('Lines per Second', "lines_per_second"),
+                        ('Batch Latency p50', "batch_latency_p50"), ('Batch Latency p99', "batch_latency_p99")]:
+        properties[metric] = {lang: profiles[lang][key] if lang in profiles else None for lang in languages}
+
+    return properties
+
+
+def load_language_statistics(out_dir, languages, suffix):
+    """Statistics saved by compute_token_frequency for each language (and "All") in `{name}_{suffix}.json`."""
+    statistics = {}
     for lang in languages:
-        if unk_token in vocab_frequencies[lang]:
-            properties['Coverage'][lang] = 1. - (vocab_frequencies[lang][unk_token] / number_of_tokens[lang])
+        name = "token_frequencies" if lang == "All" else f"token_freq_{lang}"
+        statistics_path = os.path.join(out_dir, f"{name}_{suffix}.json")
+        if not path.exists(statistics_path):
+            logging.warning(f"Statistics {suffix} not found for {lang} ({statistics_path}).")
+            continue
+        with open(statistics_path) as f:
+            statistics[lang] = json.load(f)
+    return statistics
+
+
+def compute_batched_properties(counts, number_of_characters, unk_id=None):
+    """
+    Tokenizer properties for a batch of count vectors per language (e.g. bootstrap replicates).
+    counts: language -> (batch x vocab) array, number_of_characters: language -> (batch) array.
+    Returns metric -> key -> (batch) array, with the same keys as `get_properties`.
+    """
+    languages = list(counts)
+    number_of_tokens = {lang: counts[lang].sum(axis=1) for lang in languages}
+    probabilities = {lang: counts[lang] / number_of_tokens[lang][:, None] for lang in languages}
+
+    properties = {'JSD': {}, 'Average Rank': {}, 'Characters per Token': {}, 'Coverage': {}}
+    for lang1, lang2 in combinations(languages, 2):
+        properties['JSD'][f'{lang1}-{lang2}'] = compute_paired_jsd(probabilities[lang1], probabilities[lang2])
+    for lang in languages:
+        sorted_probabilities = -np.sort(-probabilities[lang], axis=1)
+        properties['Average Rank'][lang] = sorted_probabilities @ np.arange(sorted_probabilities.shape[1])
+        properties['Characters per Token'][lang] = number_of_characters[lang] / number_of_tokens[lang]
+        if unk_id is not None:
+            properties['Coverage'][lang] = 1. - counts[lang][:, unk_id] / number_of_tokens[lang]
+    return properties
+
+
+def bootstrap_properties(unit_counts, unit_characters, unk_id=None, n_bootstrap=200, confidence=0.95, seed=0,
+                         chunk_size=10, lang_weights=None):
+    """
+    Bootstrap confidence intervals of the tokenizer properties.
+
+    The data of each language is split into units (e.g. sampled lines), unit_counts maps a language to a
+    (units x vocab) sparse or dense count matrix and unit_characters to the (units) numbers of characters.
+    Units are resampled with replacement within each language, "All" is the sum of the resampled languages
+    (weighted by lang_weights if given). Replicates are processed in chunks of chunk_size to bound the memory.
+    Returns metric -> key -> [lower, upper].
+    """
+    rng = np.random.default_rng(seed)
+    if lang_weights is None:
+        lang_weights = {lang: 1 for lang in unit_counts}
+    replicates = defaultdict(lambda: defaultdict(list))
+    for chunk_start in range(0, n_bootstrap, chunk_size):
+        n_replicates = min(chunk_size, n_bootstrap - chunk_start)
+        counts, number_of_characters = {}, {}
+        for lang, lang_counts in unit_counts.items():
+            n_units = lang_counts.shape[0]
+            # how many times each unit is drawn in each replicate
+            weights = rng.multinomial(n_units, np.full(n_units, 1. / n_units), size=n_replicates)
+            counts[lang] = np.asarray(lang_counts.T @ weights.T).T
+            number_of_characters[lang] = weights @ unit_characters[lang]
+        counts["All"] = sum(lang_weights[lang] * counts[lang] for lang in unit_counts)
+        number_of_characters["All"] = sum(lang_weights[lang] * number_of_characters[lang] for lang in unit_counts)
+
+        for metric, values in compute_batched_properties(counts, number_of_characters, unk_id).items():
+            for key, value in values.items():
+                replicates[metric][key].append(value)
+
+    quantiles = [(1. - confidence) / 2., (1. + confidence) / 2.]
+    return {metric: {key: np.quantile(np.concatenate(values), quantiles).tolist() for key, values in keys.items()}
+            for metric, keys in replicates.items()}
+
+
+def get_bootstrap_shard_size(lang2data, n_shards=BOOTSTRAP_SHARDS):
+    """
+    Bootstrap shard size (in characters) giving about n_shards shards to the language with the least data. The
+    characters are estimated by the file sizes in bytes, so languages with multi-byte characters get fewer shards.
+    """
+    smallest = min(sum(os.path.getsize(data_path) for data_path in data_paths) for data_paths in lang2data.values())
+    return max(1, smallest // n_shards)
+
+
+def sample_lines(data_paths, n_lines, rng):
+    """
+    Sample lines from the files without reading them whole. The lines are allocated to the files proportionally
+    to their sizes and each line is the one following a random byte offset (i.e. lines following long lines are
+    slightly more likely to be sampled). Compressed files cannot be sampled this way.
+    """
+    for data_path in data_paths:
+        if is_compressed(data_path):
+            raise ValueError(f"Cannot sample lines from a compressed file {data_path}, decompress it first.")
+    sizes = np.array([os.path.getsize(data_path) for data_path in data_paths], dtype=np.float64)
+    allocation = np.floor(n_lines * sizes / sizes.sum()).astype(int)
+    # distribute the remaining lines to the files with the largest remainders
+    remainders = n_lines * sizes / sizes.sum() - allocation
+    allocation[np.argsort(-remainders)[:n_lines - allocation.sum()]] += 1
+
+    lines = []
+    for data_path, size, n_file_lines in zip(data_paths, sizes.astype(int), allocation):
+        if n_file_lines == 0 or size == 0:
+            continue
+        with open(data_path, "rb") as f:
+            for offset in np.sort(rng.integers(0, size, size=n_file_lines)):
+                f.seek(offset)
+                if offset > 0:
+                    # skip the rest of the line the offset falls into
+                    f.readline()
+                line = f.readline()
+                if not line:
+                    # wrap around to the first line
+                    f.seek(0)
+                    line = f.readline()
+                lines.append(line.decode("utf-8").replace("\r\n", "\n"))
+    return lines
+
+
+def get_sampled_properties(lang2data, tokenizer, n_lines, unk_token=UNK_TOKEN, pretokenized=False, seed=0,
+                           n_bootstrap=200, output_path=None):
+    """
+    Approximate tokenizer properties from n_lines lines sampled from the data of each language,
+    with bootstrap confidence intervals (lines are resampled within each language).
+    For "All", the sample of each language is weighted by the ratio of the language data size to the sample size.
+    Pretokenized pieces not in the vocabulary are left out of the counts and reported in output_path
+    (`token_freq_{lang}_sample_unknown_pieces.json`).
+    """
+    rng = np.random.default_rng(seed)
+    vocab = tokenizer.get_vocab()
+    vocab_size = get_vocab_size(vocab)
+
+    line_counts, line_characters, lang_weights = {}, {}, {}
+    for lang, data_paths in lang2data.items():
+        logging.info(f"Sampling {n_lines} lines for {lang}")
+        lines = sample_lines(data_paths, n_lines, rng)
+        if pretokenized:
+            token_counts = TokenCounts(vocab_size)
+            pieces, piece_index, piece_counts, lengths = index_pieces([line.split() for line in lines])
+            flat_ids = count_pieces(token_counts, pieces, piece_counts, vocab)[piece_index]
+            if output_path is not None:
+                save_unknown_pieces(token_counts, output_path, f"token_freq_{lang}_sample")
         else:
-            logging.warning(f"Unknown token {unk_token} not in vocabulary for language {lang}.")
-            properties['Coverage'][lang] = None
-            
+            input_ids = tokenize_lines([line.rstrip() for line in lines], tokenizer)
+            lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+            flat_ids = np.fromiter(chain.from_iterable(input_ids), dtype=np.int64, count=lengths.sum())
+        # (lines x vocab) counts, duplicate ids within a line are summed, unknown pieces are left out
+        known = flat_ids >= 0
+        line_counts[lang] = sparse.csr_matrix(
+            (np.ones(known.sum(), dtype=np.int64),
+             (np.repeat(np.arange(len(lengths)), lengths)[known], flat_ids[known])),
+            shape=(len(lengths), vocab_size))
+        line_characters[lang] = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+        lang_weights[lang] = sum(os.path.getsize(data_path) for data_path in data_paths) / \
+            sum(len(line.encode("utf-8")) for line in lines)
+
+    counts = {lang: np.asarray(lang_counts.sum(axis=0)) for lang, lang_counts in line_counts.items()}
+    counts["All"] = sum(lang_weights[lang] * counts[lang] for lang in line_counts)
+    number_of_characters = {lang: np.array([characters.sum()]) for lang, characters in line_characters.items()}
+    number_of_characters["All"] = sum(lang_weights[lang] * number_of_characters[lang] for lang in line_characters)
+
+    unk_id = vocab.get(unk_token)
+    if unk_id is None:
+        logging.warning(f"Unknown token {unk_token} not in vocabulary.")
+    logging.info("Computing tokenizer properties on the sample...")
+    properties = {metric: {key: float(value[0]) for key, value in values.items()}
+                  for metric, values in compute_batched_properties(counts, number_of_characters, unk_id).items()}
+    if unk_id is None:
+        properties['Coverage'] = {lang: None for lang in counts}
+    logging.info(f"Computing {n_bootstrap} bootstrap replicates...")
+    properties['Confidence Intervals'] = bootstrap_properties(line_counts, line_characters, unk_id,
+                                                              n_bootstrap=n_bootstrap, seed=seed,
+                                                              lang_weights=lang_weights)
+    properties['Sample'] = {'lines per language': n_lines, 'seed': seed, 'bootstrap replicates': n_bootstrap}
     return properties
 
 
@@ -122,25 +307,74 @@ def main(args):
         tokenizer.save_pretrained(tokenizer_path)
 
     # load the tokenizer (even if the files are pre-tokenized, we need some info about from the tokenizer itself)
+    rss_before_tokenizer = get_current_rss_mb()
     tokenizer = get_tokenizer(tokenizer_path)
+    rss_after_tokenizer = get_current_rss_mb()
 
     lang2data = defaultdict(list)
     for lang, data_path in zip(args.languages, args.data_list):
         lang2data[lang].append(data_path)
 
-    for lang, data_paths in lang2data.items():
-        if not path.exists(os.path.join(tokenizer_path, f"token_freq_{lang}_decoded.json")):
-            logging.info(f"Computing token frequencies for {lang}")
-            compute_frequencies(data_paths, tokenizer=tokenizer, name=f'token_freq_{lang}',
-                                pretokenized=args.pretokenized, output_path=tokenizer_path)
-    if not path.exists(os.path.join(tokenizer_path, "token_frequencies_decoded.json")):
-        compute_frequencies(args.data_list, tokenizer, pretokenized=args.pretokenized, output_path=tokenizer_path)
+    output_file = os.path.join(tokenizer_path, "tokenizer_properties.json")
+    if args.sample:
+        t_properties = get_sampled_properties(lang2data, tokenizer, args.sample, unk_token=args.unk_token,
+                                              pretokenized=args.pretokenized, seed=args.seed,
+                                              n_bootstrap=args.n_bootstrap, output_path=tokenizer_path)
+        logging.info(f"Saving sampled tokenizer properties to {output_file}")
+        with open(output_file, "w") as f:
+            json.dump(t_properties, f, indent=4)
+        return
 
-    number_of_characters = compute_number_of_characters(lang2data)
+    # per-language, "All" and character counts are computed in a single pass over the files,
+    # the frequencies over all the data need all the files to be read
+    compute_all = not path.exists(os.path.join(tokenizer_path, "token_frequencies_decoded.json")) or \
+        not path.exists(os.path.join(tokenizer_path, "token_frequencies_words.json"))
+    # the bootstrap needs the counts of the shards of each language
+    count_lang2data = {lang: data_paths for lang, data_paths in lang2data.items()
+                       if compute_all or not path.exists(os.path.join(tokenizer_path, f"token_freq_{lang}_decoded.json"))
+                       or not path.exists(os.path.join(tokenizer_path, f"token_freq_{lang}_words.json"))
+                       or (args.bootstrap and not path.exists(os.path.join(tokenizer_path, f"token_freq_{lang}_shards.npz")))}
+    bootstrap_shard_size = None
+    if args.bootstrap:
+        bootstrap_shard_size = args.bootstrap_shard_size or get_bootstrap_shard_size(lang2data)
+        logging.info(f"Bootstrap shards of {bootstrap_shard_size} characters")
+    number_of_characters = {}
+    if count_lang2data:
+        logging.info(f"Computing token frequencies for {', '.join(count_lang2data)}")
+        number_of_characters = compute_language_frequencies(count_lang2data, tokenizer, pretokenized=args.pretokenized,
+                                                            output_path=tokenizer_path, save_all=compute_all,
+                                                            num_workers=args.num_workers,
+                                                            cache_dir=args.cache_dir,
+                                                            top_bigrams=args.top_bigrams,
+                                                            word_index_dir=args.word_index_dir,
+                                                            bootstrap_shard_size=bootstrap_shard_size,
+                                                            distinct=args.distinct)
+    number_of_characters.update(compute_number_of_characters(
+        {lang: data_paths for lang, data_paths in lang2data.items() if lang not in number_of_characters},
+        cache_dir=args.cache_dir))
+    number_of_characters["All"] = sum(number_of_characters[lang] for lang in lang2data)
 
-    t_properties = get_properties(args.languages, tokenizer_path, number_of_characters, args.unk_token)
+    # the language pairs of the properties and of their confidence intervals are in the order of lang2data
+    t_properties = get_properties(list(lang2data), tokenizer_path, number_of_characters, args.unk_token,
+                                  jsd_matrix_file=os.path.join(tokenizer_path, "tokenizer_properties_jsd.npz"))
+    t_properties['Memory'] = {
+        'Tokenizer RSS (MB)': rss_after_tokenizer - rss_before_tokenizer if rss_before_tokenizer is not None else None,
+        'Peak RSS (MB)': get_peak_rss_mb(),
+    }
+    if args.bootstrap:
+        shard_counts, shard_characters = {}, {}
+        for lang in lang2data:
+            shard_counts[lang], shard_characters[lang] = load_bootstrap_shards(tokenizer_path, f"token_freq_{lang}")
+            if len(shard_characters[lang]) < MIN_BOOTSTRAP_SHARDS:
+                logging.warning(f"Only {len(shard_characters[lang])} bootstrap shards of {lang}, its confidence "
+                                f"intervals are unreliable with fewer than {MIN_BOOTSTRAP_SHARDS} shards. Use a "
+                                f"smaller --bootstrap_shard_size.")
+        logging.info(f"Computing {args.n_bootstrap} bootstrap replicates over "
+                     f"{sum(len(characters) for characters in shard_characters.values())} shards...")
+        t_properties['Confidence Intervals'] = bootstrap_properties(
+            shard_counts, shard_characters, tokenizer.get_vocab().get(args.unk_token), n_bootstrap=args.n_bootstrap,
+            seed=args.seed)
 
-    output_file = os.path.join(tokenizer_path, "tokenizer_properties.json")
     # save results
     logging.info(f"Saving tokenizer properties to {output_file}")
     with open(output_file, "w") as f:
@@ -165,6 +399,44 @@ if __name__ == "__main__":
     parser.add_argument(
         "-u", "--unk_token", type=str, help="UNK token", required=False, default=UNK_TOKEN
     )
+    parser.add_argument(
+        "-w", "--num_workers", type=int, help="Number of processes counting the token frequencies",
+        required=False, default=1
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, help="Directory with cached per-file token counts", required=False, default=None
+    )
+    parser.add_argument(
+        "--word_index_dir", type=str, required=False, default=None,
+        help="Directory with per-file word counts, the token frequencies are derived from the unique words"
+    )
+    parser.add_argument(
+        "--top_bigrams", type=int, help="Number of the most frequent token bigrams to save per language",
+        required=False, default=None
+    )
+    parser.add_argument(
+        "--distinct", action="store_true",
+        help="Also save the estimated numbers of distinct words and characters per language"
+    )
+    parser.add_argument(
+        "--sample", type=int, required=False, default=None,
+        help="Estimate the properties from this many randomly sampled lines per language (with bootstrap "
+             "confidence intervals) instead of counting all the data"
+    )
+    parser.add_argument(
+        "--bootstrap", action="store_true",
+        help="Add bootstrap confidence intervals of the properties, resampling shards of the data of each language "
+             "(the counts of the shards are kept in the counting pass)"
+    )
+    parser.add_argument(
+        "--bootstrap_shard_size", type=int, required=False, default=None,
+        help=f"Number of characters in a bootstrap shard (by default about {BOOTSTRAP_SHARDS} shards of the "
+             f"language with the least data)"
+    )
+    parser.add_argument("--seed", type=int, help="Seed of the sampling", required=False, default=0)
+    parser.add_argument(
+        "--n_bootstrap", type=int, help="Number of bootstrap replicates", required=False, default=200
+    )
     
     args = parser.parse_args()
     main(args)
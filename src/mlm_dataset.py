@@ -8,6 +8,9 @@ from typing import Any, Callable, Dict, List, NewType, Optional, Tuple, Union
 import torch
 from transformers.tokenization_utils_base import BatchEncoding, PreTrainedTokenizerBase
 import logging
+
+from utils import open_text_file
+
 rng = np.random.RandomState(2021)
 
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +28,7 @@ class LineByLineTextDataset(Dataset):
             new_lines=[]
             logging.info(file_path)
             assert os.path.isfile(file_path), "Input file path {} not found".format(file_path)
-            with open(file_path, encoding="utf-8") as f:
+            with open_text_file(file_path) as f:
                 new_lang_lines = [line for line in tqdm(f.readlines(), desc=f"reading lines {name}, is random: {randomize}") if (len(line) > 0 and not line.isspace())]
                 new_lines+=new_lang_lines
             if portion>=0 and is_eval:
@@ -3,54 +3,222 @@ import numpy as np
 from collections import defaultdict
 import json
 import csv
+import sqlite3
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from transformers import XLMRobertaTokenizerFast
 import logging
 import pandas as pd
+from scipy.special import xlogy
 from collections import OrderedDict
+from functools import lru_cache
 
 TOKENIZERS_DIR = "/home/limisiewicz/my-luster/entangled-in-scripts/tokenizers"
 MODELS_DIR = "/home/limisiewicz/my-luster/entangled-in-scripts/models"
+# tokens ordered by id of the binary frequency files (`{name}.npy`), named by the fingerprint of the vocabulary,
+# which is recorded next to each binary file in `{name}_vocab.txt` (written by compute_token_frequency.py)
+FREQUENCY_VOCAB_FILE = "token_vocab_{fingerprint}.json"
+FREQUENCY_VOCAB_ID_SUFFIX = "_vocab.txt"
+# index of all the evaluation results (`*_all.txt`) in MODELS_DIR, see `update_results_store`
+RESULTS_STORE_FILE = "results_store.sqlite"
+RESULTS_FILE_SUFFIX = "_all.txt"
+# tokenizers and frequency tables kept in memory, and threads loading them
+ARTIFACT_CACHE_SIZE = 256
+LOADER_THREADS = 8
 
 def get_tokenizer_path(tokenizer_dir, tokenizer_type, lang, alpha, NV):
     return os.path.join(tokenizer_dir, tokenizer_type, lang, f"alpha-{alpha}_N-{NV}")
 
 
+# memoized loading of the artifacts in a thread pool
+_artifact_cache = OrderedDict()
+_artifact_cache_lock = threading.Lock()
+_artifact_executor = ThreadPoolExecutor(LOADER_THREADS, thread_name_prefix="artifact_loader")
+
+
+def _get_mtime(path):
+    """Modification time of a file, or of the latest modified file in a directory."""
+    if os.path.isdir(path):
+        return max([entry.stat().st_mtime_ns for entry in os.scandir(path)], default=os.stat(path).st_mtime_ns)
+    return os.stat(path).st_mtime_ns
+
+
+def load_memoized(load, path):
+    """
+    Future of `load(path)` run in the loader threads, memoized by path and modification time in a process-wide LRU
+    cache, so that loading the same unchanged artifact again (also while it is being loaded) doesn't read it again.
+    The loaded objects are shared by all the callers and shouldn't be modified.
+    """
+    key = (load, path, _get_mtime(path))
+    with _artifact_cache_lock:
+        future = _artifact_cache.get(key)
+        if future is not None:
+            _artifact_cache.move_to_end(key)
+            return future
+        future = _artifact_executor.submit(load, path)
+        _artifact_cache[key] = future
+        while len(_artifact_cache) > ARTIFACT_CACHE_SIZE:
+            _artifact_cache.popitem(last=False)
+
+    def forget_failed(done):
+        # failed loads are not memoized
+        if done.exception() is not None:
+            with _artifact_cache_lock:
+                _artifact_cache.pop(key, None)
+
+    future.add_done_callback(forget_failed)
+    return future
+
+
+def _load_tokenizer(tokenizer_path):
+    return XLMRobertaTokenizerFast.from_pretrained(tokenizer_path, unk_token="<unk>")
+
+
+def _load_json(json_path):
+    with open(json_path) as f:
+        return json.load(f)
+
+
+def _submit_tokenizer(tokenizer_dir, tokenizer_type, lang, alpha, NV):
+    return load_memoized(_load_tokenizer, get_tokenizer_path(tokenizer_dir, tokenizer_type, lang, alpha, NV))
+
+
+def _submit_token_frequencies(tokenizer_dir, tokenizer_type, lang, alpha, NV):
+    tokenizer_path = get_tokenizer_path(tokenizer_dir, tokenizer_type, lang, alpha, NV)
+    return load_memoized(_load_json, os.path.join(tokenizer_path, "decoded_token_frequencies.json"))
+
+
 # getting tokenizer / vocabularies
 def get_tokenizer(tokenizer_dir, tokenizer_type, lang, alpha, NV):
-    tokenizer_path = get_tokenizer_path(tokenizer_dir, tokenizer_type, lang, alpha, NV)
-    return XLMRobertaTokenizerFast.from_pretrained(tokenizer_path, unk_token="<unk>")
+    return _submit_tokenizer(tokenizer_dir, tokenizer_type, lang, alpha, NV).result()
 
 
 def get_token_frequencies(tokenizer_dir, tokenizer_type, lang, alpha, NV):
-    tokenizer_path = get_tokenizer_path(tokenizer_dir, tokenizer_type, lang, alpha, NV)
-    with open(os.path.join(tokenizer_path, "decoded_token_frequencies.json")) as f:
-        frequencies = json.load(f)
-    return frequencies
+    return _submit_token_frequencies(tokenizer_dir, tokenizer_type, lang, alpha, NV).result()
+
+
+@lru_cache(maxsize=None)
+def _load_frequency_vocabulary(vocab_path, mtime):
+    with open(vocab_path, encoding="utf-8") as f:
+        tokens = json.load(f)
+    token_ids = [token_id for token_id, token in enumerate(tokens) if token is not None]
+    sorted_token_ids = sorted(token_ids, key=tokens.__getitem__)
+    return tokens, token_ids, sorted_token_ids
+
+
+def load_frequency_vocabulary(stats_path):
+    """
+    Returns tokens indexed by id (None for unused ids), the used ids and the ids sorted by token string of the binary
+    counts of a frequency file, or None if their vocabulary is not recorded.
+    Cached until the vocabulary file changes.
+    """
+    fingerprint_path = get_frequency_array_path(stats_path)[:-len(".npy")] + FREQUENCY_VOCAB_ID_SUFFIX
+    if not os.path.exists(fingerprint_path):
+        return None
+    with open(fingerprint_path) as f:
+        fingerprint = f.read().strip()
+    vocab_path = os.path.join(os.path.dirname(stats_path), FREQUENCY_VOCAB_FILE.format(fingerprint=fingerprint))
+    if not os.path.exists(vocab_path):
+        return None
+    return _load_frequency_vocabulary(vocab_path, os.path.getmtime(vocab_path))
+
+
+def get_frequency_array_path(stats_path):
+    """Path of the binary counts saved next to a `{name}.json` or `{name}_decoded.json` frequency file."""
+    base_path = stats_path[:-len(".json")] if stats_path.endswith(".json") else stats_path
+    if base_path.endswith("_decoded"):
+        base_path = base_path[:-len("_decoded")]
+    return base_path + ".npy"
+
+
+def load_frequency_array(stats_path):
+    """
+    Memory-maps the dense counts indexed by token id, returns None if there are no binary counts with a matching
+    vocabulary (the json file is used then).
+    """
+    array_path = get_frequency_array_path(stats_path)
+    if not os.path.exists(array_path):
+        return None
+    vocabulary = load_frequency_vocabulary(stats_path)
+    if vocabulary is None:
+        return None
+    counts = np.load(array_path, mmap_mode="r")
+    if len(counts) != len(vocabulary[0]):
+        logging.warning(f"The vocabulary of {array_path} doesn't match, using the json file.")
+        return None
+    return counts
+
+
+def load_token_frequencies(stats_path, decoded=False):
+    """
+    Loads a frequency file saved by compute_token_frequency.py.
+    Uses the memory-mapped binary counts if they exist, otherwise parses the json file.
+    Decoded frequencies are keyed by token and sorted by token, otherwise they are keyed by the token id (as string)
+    and sorted by id.
+    """
+    counts = load_frequency_array(stats_path)
+    if counts is None:
+        with open(stats_path, 'r') as f:
+            return json.load(f)
+
+    tokens, token_ids, sorted_token_ids = load_frequency_vocabulary(stats_path)
+    if decoded:
+        return OrderedDict(zip([tokens[token_id] for token_id in sorted_token_ids],
+                               counts[sorted_token_ids].tolist()))
+    return OrderedDict(zip(map(str, token_ids), counts[token_ids].tolist()))
 
 
 def get_token_stats(tokenizer_dir, tokenizer_type, languages, alphas, NVs):
+    # all the files are read in parallel
     token_stats = {}
     for alpha in alphas:
         token_stats[alpha] = {}
         for lang, NV in zip(languages, NVs):
-            token_stats[alpha][lang] = get_token_frequencies(
+            token_stats[alpha][lang] = _submit_token_frequencies(
                 tokenizer_dir, tokenizer_type, lang, alpha, NV
             )
-    return token_stats
+    return {alpha: {lang: future.result() for lang, future in stats.items()} for alpha, stats in token_stats.items()}
 
 
 def get_tokenizers(tokenizer_dir, tokenizer_type, languages, alphas, NVs):
+    # all the tokenizers are loaded in parallel
     tokenizers = {}
     for alpha in alphas:
         tokenizers[alpha] = {}
         for lang, NV in zip(languages, NVs):
-            tokenizers[alpha][lang] = get_tokenizer(
+            tokenizers[alpha][lang] = _submit_tokenizer(
                 tokenizer_dir, tokenizer_type, lang, alpha, NV
             )
-    return tokenizers
+    return {alpha: {lang: future.result() for lang, future in alpha_tokenizers.items()}
+            for alpha, alpha_tokenizers in tokenizers.items()}
+
+
+def prefetch_artifacts(tokenizer_dir, tokenizer_types, languages, alphas, NVs, tokenizers=True, token_stats=True):
+    """
+    Starts loading the tokenizers and token frequencies of all the tokenizer types and alphas (with languages zipped
+    with NVs, as in `get_tokenizers`) in the background, so that the later calls return them from memory.
+    Returns the futures, missing artifacts are skipped.
+    """
+    submit_functions = [submit for submit, load in ((_submit_tokenizer, tokenizers),
+                                                    (_submit_token_frequencies, token_stats)) if load]
+    futures = []
+    for tokenizer_type in tokenizer_types:
+        for alpha in alphas:
+            for lang, NV in zip(languages, NVs):
+                for submit in submit_functions:
+                    try:
+                        futures.append(submit(tokenizer_dir, tokenizer_type, lang, alpha, NV))
+                    except FileNotFoundError:
+                        continue
+    return futures
 
 
 def compute_char_stats(token_stats, char_fn, skip_tokens):
+    # Unicode blocks are looked up for all the characters at once
+    if isinstance(getattr(char_fn, "__self__", None), UnicodeBlocks) and \
+            getattr(char_fn, "__func__", None) is UnicodeBlocks.get_block:
+        return char_fn.__self__.get_block_stats(token_stats, skip_tokens)
     char_stats = {}
     for token, freq in token_stats.items():
         if token in skip_tokens:
@@ -82,14 +250,61 @@ class UnicodeBlocks:
             for row in reader:
                 # convert first and second row from hex string to int
                 self.blocks.append((int(row[0], 16), int(row[1], 16), row[2]))
+        self.block_names = np.array([block[2] for block in self.blocks] + [None], dtype=object)
+        # the same name may be given to several ranges, statistics are aggregated by name (the last one is no block)
+        self.names, self.block_name_ids = np.unique(self.block_names[:-1].astype(str), return_inverse=True)
+        self.names = np.append(self.names.astype(object), None)
+        self.block_name_ids = np.append(self.block_name_ids, len(self.names) - 1)
+
+        # index of disjoint intervals [boundaries[i], boundaries[i + 1]), each assigned to the first listed block
+        # containing it (-1 outside of all blocks)
+        self.boundaries = np.unique([bound for start, end, _ in self.blocks for bound in (start, end + 1)])
+        self.interval_blocks = np.full(len(self.boundaries), -1, dtype=np.int64)
+        for block_idx, (start, end, _) in reversed(list(enumerate(self.blocks))):
+            self.interval_blocks[np.searchsorted(self.boundaries, start):np.searchsorted(self.boundaries, end + 1)] = \
+                block_idx
+
+        self._block_cache = {}
+        self._warned = set()
+
+    def get_block_indices(self, code_points):
+        """Indices to self.blocks of the blocks of an array of code points (-1 for code points not in any block)."""
+        code_points = np.asarray(code_points)
+        block_indices = self.interval_blocks[np.maximum(np.searchsorted(self.boundaries, code_points, side="right") - 1, 0)]
+        block_indices[code_points < self.boundaries[0]] = -1
+        for code_point in np.unique(code_points[block_indices == -1]):
+            self._warn_unknown(int(code_point))
+        return block_indices
+
+    def get_blocks(self, code_points):
+        """Names of the blocks of an array of code points (None for code points not in any block)."""
+        return self.block_names[self.get_block_indices(code_points)]
 
     def get_block(self, char):
-        char_int = ord(char)
-        for block in self.blocks:
-            if char_int >= block[0] and char_int <= block[1]:
-                return block[2]
+        if char not in self._block_cache:
+            self._block_cache[char] = self.get_blocks([ord(char)])[0]
+        return self._block_cache[char]
+
+    def get_block_stats(self, token_stats, skip_tokens):
+        """Frequencies of the blocks of the characters of the tokens, as `compute_char_stats` with `get_block`."""
+        tokens = [token for token in token_stats if token not in skip_tokens]
+        text = "".join(tokens)
+        code_points = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        freqs = np.asarray([token_stats[token] for token in tokens])
+        char_freqs = np.repeat(freqs, [len(token) for token in tokens])
+        # blocks in the order of their first occurrence
+        name_ids = self.block_name_ids[self.get_block_indices(code_points)]
+        name_order, first_occurrence = np.unique(name_ids, return_index=True)
+        block_freqs = np.bincount(name_ids, weights=char_freqs, minlength=len(self.names))
+        if char_freqs.dtype.kind in "iu":
+            block_freqs = block_freqs.astype(char_freqs.dtype)
+        return {self.names[name_id]: block_freqs[name_id].item() for name_id in name_order[np.argsort(first_occurrence)]}
+
+    def _warn_unknown(self, code_point):
         # raise ValueError(f"Character {char} not in any block")
-        logging.warning(f"Character {char} (unicode '{ord(char)}') not in any block")
+        if code_point not in self._warned:
+            self._warned.add(code_point)
+            logging.warning(f"Character {chr(code_point)} (unicode '{code_point}') not in any block")
 
 
 def get_alphabet_occurence(token_stats):
@@ -174,83 +389,116 @@ def print_alphabet_stats(tokenizer, tokenizer_name=None, NV=None):
     print(f"Ratio: {NA/NV}")
 
 
+# vocabularies as bitsets over the tokens of all the tokenizers
+# number of set bits of each byte value
+_BYTE_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+
+def popcount(bitset):
+    return int(_BYTE_POPCOUNT[bitset].sum())
+
+
+class VocabularyIndex:
+    """
+    Interns the tokens of a family of tokenizers into one id space and holds each vocabulary as a packed bitset,
+    so that the sizes of intersections of vocabularies are popcounts of their AND.
+    The vocabularies are read once per tokenizer (and again if its size changes).
+    """
+
+    def __init__(self):
+        self.tokens = []
+        self.token_ids = {}
+        # tokenizer -> (number of tokens, packed bitset)
+        self._bitsets = weakref.WeakKeyDictionary()
+        self._no_alphabet_mask = None
+
+    def _intern(self, tokens):
+        for token in tokens:
+            if token not in self.token_ids:
+                self.token_ids[token] = len(self.tokens)
+                self.tokens.append(token)
+        return np.fromiter((self.token_ids[token] for token in tokens), dtype=np.int64, count=len(tokens))
+
+    @property
+    def n_bytes(self):
+        return (len(self.tokens) + 7) // 8
+
+    def _pad(self, bitset):
+        return np.pad(bitset, (0, self.n_bytes - len(bitset)))
+
+    def no_alphabet_mask(self):
+        """Packed mask of the tokens longer than one character."""
+        if self._no_alphabet_mask is None or len(self._no_alphabet_mask) != self.n_bytes:
+            self._no_alphabet_mask = np.packbits(np.fromiter((len(token) > 1 for token in self.tokens), dtype=bool,
+                                                             count=len(self.tokens)))
+        return self._no_alphabet_mask
+
+    def bitset(self, tokenizer, no_alphabet=False):
+        n_tokens, bitset = self._bitsets.get(tokenizer, (None, None))
+        if n_tokens != len(tokenizer):
+            ids = self._intern(list(tokenizer.get_vocab().keys()))
+            mask = np.zeros(len(self.tokens), dtype=bool)
+            mask[ids] = True
+            bitset = np.packbits(mask)
+            self._bitsets[tokenizer] = (len(tokenizer), bitset)
+        bitset = self._pad(bitset)
+        return bitset & self.no_alphabet_mask() if no_alphabet else bitset
+
+    def intersection(self, tokenizers, no_alphabet=False):
+        bitsets = [self.bitset(tokenizer, no_alphabet) for tokenizer in tokenizers]
+        # the vocabularies read later may have extended the id space
+        return np.bitwise_and.reduce([self._pad(bitset) for bitset in bitsets])
+
+    def size(self, tokenizer, no_alphabet=False):
+        return popcount(self.bitset(tokenizer, no_alphabet))
+
+    def intersection_size(self, tokenizers, no_alphabet=False):
+        return popcount(self.intersection(tokenizers, no_alphabet))
+
+    def intersection_tokens(self, tokenizers, no_alphabet=False):
+        ids = np.flatnonzero(np.unpackbits(self.intersection(tokenizers, no_alphabet), count=len(self.tokens)))
+        return [self.tokens[token_id] for token_id in ids]
+
+    def overlap_matrix(self, tokenizers, no_alphabet=False):
+        """Sizes of the intersections of the vocabularies of all the pairs of tokenizers (sizes on the diagonal)."""
+        for tokenizer in tokenizers:
+            self.bitset(tokenizer)
+        bitsets = np.stack([self.bitset(tokenizer, no_alphabet) for tokenizer in tokenizers])
+        return np.stack([_BYTE_POPCOUNT[bitset & bitsets].sum(axis=1) for bitset in bitsets])
+
+
+vocabulary_index = VocabularyIndex()
+
+
 # tokens acceptance (language representation)
 def tokens_acceptance(mono_tokenizer, multi_tokenizer):
-    n_overlap = len(
-        set.intersection(
-            set(mono_tokenizer.get_vocab().keys()),
-            set(multi_tokenizer.get_vocab().keys()),
-        )
-    )
-    return n_overlap / len(mono_tokenizer.get_vocab())
+    n_overlap = vocabulary_index.intersection_size([mono_tokenizer, multi_tokenizer])
+    return n_overlap / vocabulary_index.size(mono_tokenizer)
 
 
 def tokens_acceptance_no_alphabet(mono_tokenizer, multi_tokenizer):
-    n_overlap = len(
-        set.intersection(
-            set([k for k in mono_tokenizer.get_vocab().keys() if len(k) > 1]),
-            set([k for k in multi_tokenizer.get_vocab().keys() if len(k) > 1]),
-        )
-    )
-    return n_overlap / len([k for k in mono_tokenizer.get_vocab().keys() if len(k) > 1])
+    n_overlap = vocabulary_index.intersection_size([mono_tokenizer, multi_tokenizer], no_alphabet=True)
+    return n_overlap / vocabulary_index.size(mono_tokenizer, no_alphabet=True)
 
 
 # token overlaps
 def tokens_overlap(mono_tokenizer_list, multi_tokenizer):
-
-    all_mono_vocabs = (
-        set(mono_tokenizer.get_vocab().keys()) for mono_tokenizer in mono_tokenizer_list
-    )
-
-    all_mono_overlap = set.intersection(*all_mono_vocabs)
-    n_all_mono_overlap = len(all_mono_overlap)
-    n_all_overlap = len(
-        set.intersection(all_mono_overlap, set(multi_tokenizer.get_vocab().keys()))
-    )
-    return n_all_mono_overlap / len(mono_tokenizer_list[0].get_vocab())
+    n_all_mono_overlap = vocabulary_index.intersection_size(mono_tokenizer_list)
+    return n_all_mono_overlap / vocabulary_index.size(mono_tokenizer_list[0])
 
 
 def tokens_overlap_exact(mono_tokenizer_list, multi_tokenizer):
-
-    all_mono_vocabs = (
-        set(mono_tokenizer.get_vocab().keys()) for mono_tokenizer in mono_tokenizer_list
-    )
-
-    all_mono_overlap = set.intersection(*all_mono_vocabs)
-    n_all_mono_overlap = len(all_mono_overlap)
-    n_all_overlap = len(
-        set.intersection(all_mono_overlap, set(multi_tokenizer.get_vocab().keys()))
-    )
-    return n_all_overlap / len(mono_tokenizer_list[0].get_vocab())
+    n_all_overlap = vocabulary_index.intersection_size([*mono_tokenizer_list, multi_tokenizer])
+    return n_all_overlap / vocabulary_index.size(mono_tokenizer_list[0])
 
 
 def tokens_overlap_exact_no_alphabet(mono_tokenizer_list, multi_tokenizer):
-
-    all_mono_vocabs = (
-        set([k for k in mono_tokenizer.get_vocab().keys() if len(k) > 1])
-        for mono_tokenizer in mono_tokenizer_list
-    )
-
-    all_mono_overlap = set.intersection(*all_mono_vocabs)
-    n_all_mono_overlap = len(all_mono_overlap)
-    n_all_overlap = len(
-        set.intersection(
-            all_mono_overlap,
-            set([k for k in multi_tokenizer.get_vocab().keys() if len(k) > 1]),
-        )
-    )
-    return n_all_overlap / len(
-        [k for k in multi_tokenizer.get_vocab().keys() if len(k) > 1]
-    )
+    n_all_overlap = vocabulary_index.intersection_size([*mono_tokenizer_list, multi_tokenizer], no_alphabet=True)
+    return n_all_overlap / vocabulary_index.size(multi_tokenizer, no_alphabet=True)
 
 
 def print_tokens_overlap(mono_tokenizer_list, multi_tokenizer):
-    all_mono_vocabs = (
-        set(mono_tokenizer.get_vocab().keys()) for mono_tokenizer in mono_tokenizer_list
-    )
-    sorted_tokens = sorted(
-        set.intersection(*all_mono_vocabs, set(multi_tokenizer.get_vocab().keys()))
-    )
+    sorted_tokens = sorted(vocabulary_index.intersection_tokens([*mono_tokenizer_list, multi_tokenizer]))
     print(sorted_tokens)
     print(f"Number of overlapping tokens: {len(sorted_tokens)}")
     print("\n")
@@ -277,8 +525,150 @@ def distribution_from_frequencies(frequencies: dict) -> OrderedDict:
     return distribution
 
 
-def get_distribution_over_vocabulary(tok_type: str, alpha: float, NV: int, languages: list[str]) -> (dict, dict):
-    
+def _jsd_on_shared_support(p, p_logp, q, q_logq, base):
+    """
+    JSD between distributions aligned on the last axis (broadcast over the others), given their p * log p.
+    Tokens in the support of only one of the distributions contribute p / 2 * (log 2 - log p) to the entropy of the
+    mixture, so only the mixture on the shared support needs to be computed:
+    JSD = (log 2 * (1 - (A_p + A_q) / 2) + sum_shared(p log p + q log q) / 2 - sum_shared(m log m)) / log base,
+    where A_p and A_q are the probability masses of the shared support.
+    """
+    shared = (p > 0) & (q > 0)
+    mixture = np.where(shared, (p + q) / 2., 0.)
+    shared_mass = (shared * (p + q)).sum(axis=-1)
+    jsd = (np.log(2.) * (1. - shared_mass / 2.)
+           + (shared * (p_logp + q_logq)).sum(axis=-1) / 2.
+           - xlogy(mixture, mixture).sum(axis=-1)) / np.log(base)
+    # rounding errors can make identical distributions slightly negative
+    return np.maximum(jsd, 0.)
+
+
+def compute_jsd_matrix(distributions, base=2.):
+    """
+    JSD between all pairs of rows of a (languages x vocab) matrix of probability distributions, as a symmetric
+    (languages x languages) matrix. The per-row p * log p is computed once and each pair is only summed over the
+    support of its first distribution (see `_jsd_on_shared_support`).
+    """
+    distributions = np.asarray(distributions, dtype=np.float64)
+    plogp = xlogy(distributions, distributions)
+    n_languages = len(distributions)
+    jsd_matrix = np.zeros((n_languages, n_languages))
+    for i in range(n_languages - 1):
+        support = np.flatnonzero(distributions[i])
+        jsd_matrix[i, i + 1:] = _jsd_on_shared_support(distributions[i, support], plogp[i, support],
+                                                       distributions[i + 1:, support], plogp[i + 1:, support], base)
+    return jsd_matrix + jsd_matrix.T
+
+
+def compute_paired_jsd(p, q, base=2.):
+    """
+    JSD between the corresponding rows of two (batch x vocab) arrays of probability distributions, e.g. the
+    bootstrap replicates of two languages. The same definition as `compute_jsd_matrix`.
+    """
+    p, q = np.asarray(p, dtype=np.float64), np.asarray(q, dtype=np.float64)
+    return _jsd_on_shared_support(p, xlogy(p, p), q, xlogy(q, q), base)
+
+
+class VocabularyDistributions:
+    """
+    Token counts of several languages as a dense (languages x vocab) matrix aligned by token id, with a single
+    vocabulary (tokens indexed by id, None for unused ids).
+    """
+
+    def __init__(self, languages, counts, tokens):
+        self.languages = list(languages)
+        self.counts = np.asarray(counts)
+        self.tokens = tokens
+        self._language_index = {lang: row for row, lang in enumerate(self.languages)}
+        self._token_ids = None
+        self._probabilities = None
+
+    @classmethod
+    def from_frequency_files(cls, stats_paths):
+        """
+        Loads the (decoded) frequency files of each language, given as a dictionary from language to path.
+        Uses the memory-mapped binary counts if they exist, otherwise the json files, aligned by token.
+        Languages with missing files are skipped.
+        """
+        languages, rows, vocabularies = [], [], []
+        for lang, stats_path in stats_paths.items():
+            counts = load_frequency_array(stats_path)
+            if counts is not None:
+                tokens = load_frequency_vocabulary(stats_path)[0]
+            else:
+                try:
+                    frequencies = load_token_frequencies(stats_path, decoded=True)
+                except FileNotFoundError:
+                    print(f"{lang} freq file not found ({stats_path}).")
+                    continue
+                tokens = list(frequencies)
+                counts = np.fromiter(frequencies.values(), dtype=np.int64, count=len(frequencies))
+            languages.append(lang)
+            rows.append(counts)
+            vocabularies.append(tokens)
+        if not languages:
+            return cls([], np.zeros((0, 0), dtype=np.int64), [])
+        if all(tokens == vocabularies[0] for tokens in vocabularies[1:]):
+            return cls(languages, np.vstack(rows), vocabularies[0])
+
+        # different vocabularies (e.g. json files without unused tokens) are aligned by token
+        tokens = sorted({token for vocabulary in vocabularies for token in vocabulary if token is not None})
+        token_ids = {token: token_id for token_id, token in enumerate(tokens)}
+        counts = np.zeros((len(languages), len(tokens)), dtype=np.int64)
+        for row, (vocabulary, language_counts) in enumerate(zip(vocabularies, rows)):
+            used = [token_id for token_id, token in enumerate(vocabulary) if token is not None]
+            np.add.at(counts[row], [token_ids[vocabulary[token_id]] for token_id in used],
+                      np.asarray(language_counts)[used])
+        return cls(languages, counts, tokens)
+
+    def __contains__(self, lang):
+        return lang in self._language_index
+
+    def __getitem__(self, lang):
+        """Distribution over the vocabulary of a language."""
+        return self.probabilities[self._language_index[lang]]
+
+    @property
+    def number_of_tokens(self):
+        return self.counts.sum(axis=1)
+
+    @property
+    def probabilities(self):
+        if self._probabilities is None:
+            self._probabilities = self.counts / self.number_of_tokens[:, None]
+        return self._probabilities
+
+    def token_id(self, token):
+        """Id of a token in the vocabulary, None if it is not in the vocabulary."""
+        if self._token_ids is None:
+            self._token_ids = {token: token_id for token_id, token in enumerate(self.tokens) if token is not None}
+        return self._token_ids.get(token)
+
+    def average_rank(self):
+        """Expected rank of a token in each language (ranking the tokens by their probability in the language)."""
+        sorted_probabilities = -np.sort(-self.probabilities, axis=1)
+        return sorted_probabilities @ np.arange(sorted_probabilities.shape[1])
+
+    def rank_std(self):
+        """Standard deviation of the rank of a token in each language."""
+        sorted_probabilities = -np.sort(-self.probabilities, axis=1)
+        ranks = np.arange(sorted_probabilities.shape[1])
+        return np.sqrt(sorted_probabilities @ ranks ** 2. - (sorted_probabilities @ ranks) ** 2.)
+
+    def jsd_matrix(self, base=2.):
+        """JSD between the distributions of all the pairs of languages (in the order of self.languages)."""
+        return compute_jsd_matrix(self.probabilities, base=base)
+
+    def coverage(self, token):
+        """1 - the share of the token (e.g. the unknown token) in each language, None if not in the vocabulary."""
+        token_id = self.token_id(token)
+        if token_id is None:
+            return None
+        return 1. - self.counts[:, token_id] / self.number_of_tokens
+
+
+def get_frequency_stats_paths(tok_type: str, alpha: float, NV: int, languages: list[str]) -> dict:
+    """Paths of the frequency files (by token id) of each language and 'All' (none for nooverlap tokenizers)."""
     tok_type_map = {'multilingual': 'sp-unigram',
                     '20l-multilingual': 'sp-unigram',
                     'merged': 'sp-unigram-merged',
@@ -287,44 +677,96 @@ def get_distribution_over_vocabulary(tok_type: str, alpha: float, NV: int, langu
                     'bpe': 'sp-bpe',
                     '20l-bpe': 'sp-bpe',
                     'bpe_nooverlap': 'sp-bpe'}
-    
-    frequencies_over_vocabulary = dict()
-    
-    # monolingual frequencies
+
+    stats_paths = dict()
     for lang in languages:
         if "nooverlap" in tok_type:
-            tokenizer_stats_path = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], lang,
-                                                f"alpha-{alpha}_N-{NV//len(languages)}",
-                                                f"token_freq_{lang}_{alpha}.json")
+            stats_paths[lang] = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], lang,
+                                             f"alpha-{alpha}_N-{NV//len(languages)}",
+                                             f"token_freq_{lang}_{alpha}.json")
         else:
-            tokenizer_stats_path = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], '-'.join(languages),
-                                                f"alpha-{alpha}_N-{NV}", f"token_freq_{lang}_{alpha}.json")
+            stats_paths[lang] = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], '-'.join(languages),
+                                             f"alpha-{alpha}_N-{NV}", f"token_freq_{lang}_{alpha}.json")
+    if "nooverlap" not in tok_type:
+        stats_paths['All'] = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], '-'.join(languages),
+                                          f"alpha-{alpha}_N-{NV}", f"token_frequencies.json")
+    return stats_paths
+
+
+def load_frequency_counts(stats_path) -> np.ndarray:
+    """Counts indexed by token id of a frequency file (memory-mapped binary counts if they exist)."""
+    counts = load_frequency_array(stats_path)
+    if counts is not None:
+        return counts
+    frequencies = load_token_frequencies(stats_path)
+    token_ids = np.fromiter(map(int, frequencies), dtype=np.int64, count=len(frequencies))
+    counts = np.zeros(token_ids.max(initial=-1) + 1, dtype=np.int64)
+    counts[token_ids] = list(frequencies.values())
+    return counts
+
+
+def get_vocabulary_distributions(tok_type: str, alpha: float, NV: int, languages: list[str]) -> VocabularyDistributions:
+    """
+    Dense counterpart of `get_distribution_over_vocabulary`: counts of the languages and 'All' over the token ids
+    (tokens are the ids as strings). The vocabulary of nooverlap tokenizers is the concatenation of the vocabularies
+    of the languages, each language is counted in its own block of ids.
+    """
+    stats_paths = get_frequency_stats_paths(tok_type, alpha, NV, languages)
+    rows = dict()
+    for lang, stats_path in stats_paths.items():
         try:
-            frequencies_over_vocabulary[lang] = json.load(open(tokenizer_stats_path, 'r'))
+            rows[lang] = load_frequency_counts(stats_path)
         except FileNotFoundError:
-            print(f"{lang} freq file not found ({tokenizer_stats_path}).")
-            continue
+            if lang == 'All':
+                print(f"Multilingual freq file not found ({stats_path}).")
+            else:
+                print(f"{lang} freq file not found ({stats_path}).")
 
-    # multilingual frequency file
     if "nooverlap" in tok_type:
-        frequencies_over_vocabulary_new = defaultdict(dict)
-        
-        for tok_idx in range(NV):
-            lang_idx = tok_idx // (NV//len(languages))
-            rel_tok_idx = str(tok_idx % (NV//len(languages)))
-            curr_lang = languages[lang_idx]
-            for lang in languages:
-                frequencies_over_vocabulary_new[lang][str(tok_idx)] = frequencies_over_vocabulary[curr_lang][rel_tok_idx] if lang == curr_lang else 0
-            frequencies_over_vocabulary_new['All'][str(tok_idx)] = frequencies_over_vocabulary[curr_lang][rel_tok_idx]
-        frequencies_over_vocabulary = frequencies_over_vocabulary_new
+        lang_NV = NV // len(languages)
+        counts = np.zeros((len(rows) + 1, lang_NV * len(languages)), dtype=np.int64)
+        for row, (lang, lang_counts) in enumerate(rows.items()):
+            offset = languages.index(lang) * lang_NV
+            block = lang_counts[:lang_NV]
+            counts[row, offset:offset + len(block)] = block
+        counts[-1] = counts[:-1].sum(axis=0)
+        row_languages = [*rows, 'All']
     else:
-        tokenizer_stats_path = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], '-'.join(languages),
-                                            f"alpha-{alpha}_N-{NV}", f"token_frequencies.json")
+        counts = np.zeros((len(rows), max((len(lang_counts) for lang_counts in rows.values()), default=0)),
+                          dtype=np.int64)
+        for row, lang_counts in enumerate(rows.values()):
+            counts[row, :len(lang_counts)] = lang_counts
+        row_languages = list(rows)
+    return VocabularyDistributions(row_languages, counts, [str(token_id) for token_id in range(counts.shape[1])])
+
+
+def get_distribution_over_vocabulary(tok_type: str, alpha: float, NV: int, languages: list[str]) -> (dict, dict):
+    """
+    Distributions and frequencies over the token ids as dictionaries keyed by the id, for each language and 'All'.
+    The arrays of get_vocabulary_distributions are cheaper to build and compare.
+    """
+
+    if "nooverlap" in tok_type:
+        # the block structured frequencies are built as arrays, see get_vocabulary_distributions
+        distributions = get_vocabulary_distributions(tok_type, alpha, NV, languages)
+        distribution_over_vocabulary, frequencies_over_vocabulary = dict(), dict()
+        for lang, counts, probabilities in zip(distributions.languages, distributions.counts,
+                                               distributions.probabilities):
+            frequencies_over_vocabulary[lang] = OrderedDict(zip(distributions.tokens, counts.tolist()))
+            distribution_over_vocabulary[lang] = OrderedDict(zip(distributions.tokens, probabilities.tolist()))
+        return distribution_over_vocabulary, frequencies_over_vocabulary
+
+    frequencies_over_vocabulary = dict()
+    for lang, tokenizer_stats_path in get_frequency_stats_paths(tok_type, alpha, NV, languages).items():
         try:
-            frequencies_over_vocabulary['All'] = json.load(open(tokenizer_stats_path, 'r'))
+            frequencies_over_vocabulary[lang] = load_token_frequencies(tokenizer_stats_path)
         except FileNotFoundError:
-            print(f"Multilingual freq file not found ({tokenizer_stats_path}).")
-    
+            if lang == 'All':
+                print(f"Multilingual freq file not found ({tokenizer_stats_path}).")
+            else:
+                print(f"{lang} freq file not found ({tokenizer_stats_path}).")
+            continue
+
     distribution_over_vocabulary = dict()
     for lang, freqs in frequencies_over_vocabulary.items():
         actual_NV = len(freqs)
@@ -358,7 +800,7 @@ def get_distribution_over_decoded_vocabulary(tok_type: str, alpha: float, NV: in
             tokenizer_stats_path = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], '-'.join(languages),
                                                 f"alpha-{alpha}_N-{NV}", f"token_freq_{lang}_{alpha}_decoded.json")
         try:
-            frequencies_over_vocabulary[lang] = json.load(open(tokenizer_stats_path, 'r'))
+            frequencies_over_vocabulary[lang] = load_token_frequencies(tokenizer_stats_path, decoded=True)
         except FileNotFoundError:
             print(f"{lang} freq file not found ({tokenizer_stats_path}).")
             continue
@@ -369,7 +811,7 @@ def get_distribution_over_decoded_vocabulary(tok_type: str, alpha: float, NV: in
         tokenizer_stats_path = os.path.join(TOKENIZERS_DIR, tok_type_map[tok_type], '-'.join(languages),
                                             f"alpha-{alpha}_N-{NV}", f"token_frequencies_decoded.json")
         try:
-            frequencies_over_vocabulary['All'] = json.load(open(tokenizer_stats_path, 'r'))
+            frequencies_over_vocabulary['All'] = load_token_frequencies(tokenizer_stats_path, decoded=True)
         except FileNotFoundError:
             print(f"Multilingual freq file not found ({tokenizer_stats_path}).")
 
@@ -382,6 +824,76 @@ def get_distribution_over_decoded_vocabulary(tok_type: str, alpha: float, NV: in
     return distribution_over_vocabulary, frequencies_over_vocabulary
     
     
+def update_results_store(models_dir=None, store_path=None) -> dict:
+    """
+    Indexes the evaluation results (`*_all.txt` json files) under models_dir into a SQLite store with a row per
+    file and numeric value. Only the files with a changed modification time are re-read, removed files are dropped.
+    Returns the results as {path relative to models_dir: {key: value}}, with None for files that couldn't be parsed.
+    """
+    models_dir = models_dir or MODELS_DIR
+    store_path = store_path or os.path.join(models_dir, RESULTS_STORE_FILE)
+
+    result_files = {}
+    for root, _, files in os.walk(models_dir):
+        for file in files:
+            if file.endswith(RESULTS_FILE_SUFFIX):
+                result_path = os.path.join(root, file)
+                result_files[os.path.relpath(result_path, models_dir)] = os.stat(result_path).st_mtime_ns
+
+    with sqlite3.connect(store_path) as connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, parsed INTEGER)")
+        connection.execute("CREATE TABLE IF NOT EXISTS results (path TEXT, key TEXT, value REAL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS results_path ON results (path)")
+        stored_files = dict(connection.execute("SELECT path, mtime_ns FROM files"))
+
+        removed = [(path,) for path in stored_files if path not in result_files]
+        changed = [path for path, mtime_ns in result_files.items() if stored_files.get(path) != mtime_ns]
+        connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        connection.executemany("DELETE FROM results WHERE path = ?", removed + [(path,) for path in changed])
+        for path in changed:
+            try:
+                with open(os.path.join(models_dir, path), 'r') as f:
+                    result = json.load(f)
+            except json.JSONDecodeError:
+                result = None
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                               (path, result_files[path], result is not None))
+            if result is not None:
+                connection.executemany("INSERT INTO results VALUES (?, ?, ?)",
+                                       [(path, key, value) for key, value in result.items()
+                                        if isinstance(value, (int, float))])
+        if removed or changed:
+            logging.info(f"Results store {store_path}: {len(changed)} files updated, {len(removed)} removed.")
+
+        results = {path: {} if parsed else None for path, parsed in connection.execute("SELECT path, parsed FROM files")}
+        for path, key, value in connection.execute("SELECT path, key, value FROM results"):
+            results[path][key] = value
+    return results
+
+
+# results index of the session per models directory, with the modification times of the indexed files
+_results_index = {}
+
+
+def get_results_index(*result_files) -> dict:
+    """
+    Results index of the session (see `update_results_store`). The store is updated only if one of the given
+    result_files (relative to MODELS_DIR) was added, changed or removed since, which costs a stat per file.
+    """
+    mtimes_ns = {}
+    for result_file in result_files:
+        try:
+            mtimes_ns[result_file] = os.stat(os.path.join(MODELS_DIR, result_file)).st_mtime_ns
+        except FileNotFoundError:
+            mtimes_ns[result_file] = None
+    cached = _results_index.get(MODELS_DIR)
+    if cached is None or any(cached[1].get(result_file) != mtime_ns for result_file, mtime_ns in mtimes_ns.items()):
+        results = update_results_store()
+        with sqlite3.connect(os.path.join(MODELS_DIR, RESULTS_STORE_FILE)) as connection:
+            cached = _results_index[MODELS_DIR] = (results, dict(connection.execute("SELECT path, mtime_ns FROM files")))
+    return cached[0]
+
+
 def get_mlm_results(tok_type: str, alpha: float, NV: int, languages: list[str],
                     seed=1234, alpha_train=0.25, metrics=('mrr', 'bpc')) -> dict:
     """
@@ -395,24 +907,20 @@ def get_mlm_results(tok_type: str, alpha: float, NV: int, languages: list[str],
     results = {m: {} for m in metrics}
     for metric in metrics:
         for lang in languages:
-            try:
-                result_file = os.path.join(MODELS_DIR, "LM", f"{tok_type}-tokenization",
-                                       f"alpha-{alpha}_alpha-train-{alpha_train}_N-{NV}_{seed}", lang,
-                                       f"{metric}_eval_mrr_eval_all.txt")
-
-                res = json.load(open(result_file, 'r'))[f"eval_{metric}"]
-            except FileNotFoundError:
-                try:
-                    result_file = os.path.join(MODELS_DIR, "LM", f"{tok_type}-tokenization",
-                                               f"alpha-{alpha}_alpha-train-{alpha_train}_N-{NV}_{seed}", lang,
-                                               f"{metric}_eval_all.txt")
-                    res = json.load(open(result_file, 'r'))[f"eval_{metric}"]
-                except FileNotFoundError:
-                    print(f"{result_file} not found.")
-                    res = 0.0
-            except json.JSONDecodeError:
-                print(f"{result_file} couldn't be parsed.")
+            result_dir = os.path.join("LM", f"{tok_type}-tokenization",
+                                      f"alpha-{alpha}_alpha-train-{alpha_train}_N-{NV}_{seed}", lang)
+            result_file = os.path.join(result_dir, f"{metric}_eval_mrr_eval_all.txt")
+            results_index = get_results_index(result_file, os.path.join(result_dir, f"{metric}_eval_all.txt"))
+            if result_file not in results_index:
+                result_file = os.path.join(result_dir, f"{metric}_eval_all.txt")
+            if result_file not in results_index:
+                print(f"{os.path.join(MODELS_DIR, result_file)} not found.")
                 res = 0.0
+            elif results_index[result_file] is None:
+                print(f"{os.path.join(MODELS_DIR, result_file)} couldn't be parsed.")
+                res = 0.0
+            else:
+                res = results_index[result_file][f"eval_{metric}"]
             results[metric][lang] = res
 
     return results
@@ -442,19 +950,20 @@ def get_downstream_results(tok_type: str, alpha: float, NV: int, languages: list
                 results[metric][src_lang][tgt_lang] = []
                 for seed in seeds:
                     if not ft_type:
-                        result_file = os.path.join(MODELS_DIR, task, f"{tok_type}-tokenization",
+                        result_file = os.path.join(task, f"{tok_type}-tokenization",
                                                    f"alpha-{alpha}_alpha-train-{alpha_train}_N-{NV}_{seed}",
                                                    src_lang, f"{metric}_evaluation", tgt_lang, f"{metric}_all.txt")
                     else:
-                        result_file = os.path.join(MODELS_DIR, f"{task}_{ft_type}", f"{tok_type}-tokenization",
+                        result_file = os.path.join(f"{task}_{ft_type}", f"{tok_type}-tokenization",
                                                    f"alpha-{alpha}_alpha-train-{alpha_train}_N-{NV}_{seed}",
                                                    src_lang, f"{metric}_evaluation", tgt_lang, f"{metric}_all.txt")
-                    try:
-                        results[metric][src_lang][tgt_lang].append(json.load(open(result_file, 'r'))[f"eval_{metric}"])
-                    except FileNotFoundError:
-                        print(f"{result_file} not found.")
-                    except json.JSONDecodeError:
-                        print(f"{result_file} couldn't be parsed.")
+                    results_index = get_results_index(result_file)
+                    if result_file not in results_index:
+                        print(f"{os.path.join(MODELS_DIR, result_file)} not found.")
+                    elif results_index[result_file] is None:
+                        print(f"{os.path.join(MODELS_DIR, result_file)} couldn't be parsed.")
+                    else:
+                        results[metric][src_lang][tgt_lang].append(results_index[result_file][f"eval_{metric}"])
                         
                 if len(results[metric][src_lang][tgt_lang]) > 0:
                     results_avg[metric][src_lang][tgt_lang] = np.mean(results[metric][src_lang][tgt_lang])
@@ -8,6 +8,9 @@ from pathlib import Path
 import shutil
 import subprocess
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from sketches import HyperLogLog
+
 def load_vocab(lang, root_dir):
     vocab = []
     vocab_file = os.path.join(root_dir, f"{lang}.vocab")
@@ -21,8 +24,9 @@ def load_vocab(lang, root_dir):
             vocab.append(subword)
     return vocab
 
-def calculate_cluster_vocab_sizes(cluster_def_path, vocab_dir, total_vocab_size):
-    """Calculate optimal vocab sizes for clusters based on union vocabulary analysis"""
+def calculate_cluster_vocab_sizes(cluster_def_path, vocab_dir, total_vocab_size, sketch_dir=None):
+    """Calculate optimal vocab sizes for clusters based on union vocabulary analysis.
+    If sketch_dir is given, the estimated number of distinct words of each cluster is reported as well."""
     cluster_re = re.compile(r"Cluster\s+(\d+)\s*:\s*(.+)", re.I)
     
     # Parse the cluster-definition file
@@ -47,6 +51,9 @@ def calculate_cluster_vocab_sizes(cluster_def_path, vocab_dir, total_vocab_size)
         vocab_sizes.append(vocab_size)
         print(f"Cluster {cluster_id}: {len(langs)} languages, union vocab size: {vocab_size}")
 
+    if sketch_dir is not None:
+        estimate_cluster_word_types(clusters, sketch_dir)
+
     total_clustered_vocab_size = sum(vocab_sizes)
     if total_clustered_vocab_size == 0:
         print("Error: Total vocabulary size is 0")
@@ -62,6 +69,33 @@ def calculate_cluster_vocab_sizes(cluster_def_path, vocab_dir, total_vocab_size)
     
     return clusters, individual_vocabs
 
+def load_word_sketch(lang, sketch_dir):
+    """Distinct word sketch of a language, saved by compute_token_frequency (token_freq_{lang}_distinct.npz)"""
+    sketch_file = os.path.join(sketch_dir, f"token_freq_{lang}_distinct.npz")
+    if not os.path.exists(sketch_file):
+        print(f"Warning: Sketch file not found: {sketch_file}")
+        return None
+    with np.load(sketch_file) as saved:
+        return HyperLogLog.from_registers(saved["words"])
+
+def estimate_cluster_word_types(clusters, sketch_dir):
+    """Estimate the number of distinct words of each cluster by merging the sketches of its languages,
+    without reading the text"""
+    word_types = {}
+    for cluster_id in sorted(clusters.keys()):
+        cluster_sketch = None
+        for lang in clusters[cluster_id]:
+            sketch = load_word_sketch(lang, sketch_dir)
+            if sketch is None:
+                continue
+            if cluster_sketch is None:
+                cluster_sketch = sketch
+            else:
+                cluster_sketch += sketch
+        word_types[cluster_id] = cluster_sketch.estimate() if cluster_sketch is not None else 0
+        print(f"Cluster {cluster_id}: ~{word_types[cluster_id]} distinct words")
+    return word_types
+
 def train_cluster_tokenizers(cluster_corpus_dir, vocab_sizes, output_dir=None, threads=128, model_type="unigram"):
     """Train tokenizers on clustered corpora with specified vocab sizes"""
     # Use separate output directory if provided, otherwise use corpus directory
@@ -118,14 +152,16 @@ if __name__ == "__main__":
         vocab_dir = sys.argv[2] if len(sys.argv) > 2 else 'monolingual_tokenizers_and_clusters/vocab_size_32'
         total_vocab_size = int(sys.argv[3]) if len(sys.argv) > 3 else 256000
         cluster_corpus_dir = sys.argv[4] if len(sys.argv) > 4 else None
+        sketch_dir = sys.argv[5] if len(sys.argv) > 5 else None
     else:
         # Original hardcoded values for backward compatibility
         cluster_def_path = "monolingual_tokenizers_and_clusters/vocab_size_32/language_clusters_l2_5.txt"
         vocab_dir = 'monolingual_tokenizers_and_clusters/vocab_size_32'
         total_vocab_size = 256000
         cluster_corpus_dir = None
+        sketch_dir = None
 
-    clusters, individual_vocabs = calculate_cluster_vocab_sizes(cluster_def_path, vocab_dir, total_vocab_size)
+    clusters, individual_vocabs = calculate_cluster_vocab_sizes(cluster_def_path, vocab_dir, total_vocab_size, sketch_dir)
     
     if clusters and individual_vocabs and cluster_corpus_dir:
         print(f"\nTraining cluster tokenizers...")
@@ -0,0 +1,183 @@
+"""
+Fixed-memory, mergeable sketches for statistics that don't fit in memory when counted exactly.
+"""
+
+import numpy as np
+
+# odd 64-bit multipliers of the multiply-shift hash functions, one per sketch row
+_HASH_SEED = 20
+_MAX_DEPTH = 16
+_HASH_MULTIPLIERS = np.random.RandomState(_HASH_SEED).randint(
+    0, 2 ** 63, size=(_MAX_DEPTH, 2), dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+
+# odd multiplier of the polynomial string hash
+_STRING_HASH_BASE = np.uint64(0x100000001B3)
+
+
+def _mix64(x):
+    """splitmix64 finalizer, spreads the bits of 64-bit keys uniformly."""
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(x):
+    """Bit lengths of uint64 values, from their 32-bit halves (exact as floats)."""
+    x = np.asarray(x, dtype=np.uint64)
+    high = (x >> np.uint64(32)).astype(np.float64)
+    low = (x & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+class CountMinSketch:
+    """
+    Count-min sketch of non-negative int64 keys with a table of candidate heavy hitters.
+
+    Estimates never underestimate the true counts, and overestimate by at most e / width * total
+    with probability 1 - exp(-depth). The candidates are the keys with the highest estimates seen so far,
+    at most `n_candidates` of them. Sketches with the same width and depth can be merged with `+=`.
+    """
+
+    def __init__(self, width=2 ** 18, depth=4, n_candidates=10000):
+        assert width & (width - 1) == 0, "Width must be a power of two."
+        assert depth <= _MAX_DEPTH, f"Depth must be at most {_MAX_DEPTH}."
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.candidates = np.zeros(0, dtype=np.int64)
+        self.total = 0
+        self.n_candidates = n_candidates
+
+    @property
+    def width(self):
+        return self.table.shape[1]
+
+    @property
+    def depth(self):
+        return self.table.shape[0]
+
+    @property
+    def error_bound(self):
+        """Upper bound of the overestimation (with probability 1 - exp(-depth))."""
+        return np.e / self.width * self.total
+
+    def _hash(self, keys):
+        shift = np.uint64(64 - int(np.log2(self.width)))
+        keys = keys.astype(np.uint64)
+        # multiply-shift hashing, the uint64 arithmetic wraps around
+        with np.errstate(over="ignore"):
+            return [((keys * a + b) >> shift).astype(np.int64) for a, b in _HASH_MULTIPLIERS[:self.depth]]
+
+    def update(self, keys, counts=None):
+        """Add counts (default 1) of the keys."""
+        keys = np.asarray(keys, dtype=np.int64)
+        if counts is None:
+            keys, counts = np.unique(keys, return_counts=True)
+        counts = np.asarray(counts, dtype=np.int64)
+        for row, indices in zip(self.table, self._hash(keys)):
+            np.add.at(row, indices, counts)
+        self.total += int(counts.sum())
+        self._update_candidates(keys)
+
+    def query(self, keys):
+        """Estimated counts of the keys."""
+        keys = np.asarray(keys, dtype=np.int64)
+        return np.min([row[indices] for row, indices in zip(self.table, self._hash(keys))], axis=0)
+
+    def _update_candidates(self, keys):
+        candidates = np.union1d(self.candidates, keys)
+        if len(candidates) > self.n_candidates:
+            estimates = self.query(candidates)
+            candidates = candidates[np.argsort(-estimates, kind="stable")[:self.n_candidates]]
+        self.candidates = candidates
+
+    def heavy_hitters(self, k):
+        """Top k (key, estimated count) pairs among the candidates, by decreasing count."""
+        estimates = self.query(self.candidates)
+        order = np.lexsort((self.candidates, -estimates))[:k]
+        return list(zip(self.candidates[order].tolist(), estimates[order].tolist()))
+
+    def __iadd__(self, other):
+        self.table += other.table
+        self.total += other.total
+        self._update_candidates(other.candidates)
+        return self
+
+
+class HyperLogLog:
+    """
+    HyperLogLog estimate of the number of distinct items (e.g. word types) in a stream.
+
+    Uses 2 ** precision one-byte registers, the relative standard error of the estimate is about
+    1.04 / sqrt(2 ** precision) (0.8% for the default precision). Sketches with the same precision can be merged
+    with `+=`, the result is the sketch of the union of the streams.
+    """
+
+    def __init__(self, precision=14):
+        assert 4 <= precision <= 18, "Precision must be between 4 and 18."
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    @property
+    def precision(self):
+        return int(np.log2(len(self.registers)))
+
+    @property
+    def relative_error(self):
+        return 1.04 / np.sqrt(len(self.registers))
+
+    @staticmethod
+    def hash_strings(strings):
+        """
+        64-bit hashes of the strings, stable across runs and processes (unlike the builtin hash).
+        A polynomial hash of the code points of all the strings at once, finalized by the splitmix64 mixer.
+        """
+        strings = list(strings)
+        lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+        code_points = np.frombuffer("".join(strings).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        # position of each code point from the end of its string
+        ends = np.cumsum(lengths)
+        positions = np.repeat(ends, lengths) - 1 - np.arange(len(code_points))
+        with np.errstate(over="ignore"):
+            powers = np.cumprod(np.full(max(lengths.max(initial=0), 1), _STRING_HASH_BASE, dtype=np.uint64))
+            terms = (code_points + np.uint64(1)) * powers[positions]
+            hashes = np.zeros(len(strings), dtype=np.uint64)
+            non_empty = lengths > 0
+            if len(terms):
+                hashes[non_empty] = np.add.reduceat(terms, (ends - lengths)[non_empty])
+            return _mix64(hashes ^ lengths.astype(np.uint64))
+
+    def update_hashes(self, hashes):
+        """Add items given by their uniformly distributed 64-bit hashes."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        rest_bits = 64 - self.precision
+        indices = (hashes >> np.uint64(rest_bits)).astype(np.int64)
+        rest = hashes & np.uint64(2 ** rest_bits - 1)
+        # rank is the position of the first set bit of the remaining bits
+        ranks = (rest_bits + 1 - _bit_length(rest)).astype(np.uint8)
+        np.maximum.at(self.registers, indices, ranks)
+
+    def update(self, strings):
+        """Add the strings."""
+        self.update_hashes(self.hash_strings(set(strings)))
+
+    def estimate(self):
+        """Estimated number of distinct items."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def __iadd__(self, other):
+        assert len(self.registers) == len(other.registers), "Only sketches with the same precision can be merged."
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    @classmethod
+    def from_registers(cls, registers):
+        sketch = cls(int(np.log2(len(registers))))
+        sketch.registers[:] = registers
+        return sketch
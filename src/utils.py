@@ -1,10 +1,23 @@
+import gzip
+import hashlib
+import io
 import json
+import logging
+import lzma
+import mmap
 import os
+import queue
+import threading
+import time
 from collections import OrderedDict
 
+import numpy as np
+
 from transformers import XLMRobertaTokenizerFast
 
-from notebooks.notebook_utils import distribution_from_frequencies
+# the names of the binary frequency files are shared by the writer (compute_token_frequency.py) and the notebooks
+from notebooks.notebook_utils import FREQUENCY_VOCAB_FILE, FREQUENCY_VOCAB_ID_SUFFIX, VocabularyDistributions, \
+    distribution_from_frequencies, load_token_frequencies
 
 
 def load_config(config_path):
@@ -36,6 +49,287 @@ def load_config(config_path):
         return json.load(fp)
 
 
+# size of the byte ranges counted by a single worker in the sharded mode
+SHARD_SIZE = 64 * 1024 * 1024
+# content hashes of the data files in a cache directory, keyed by path, size and modification time
+FILE_HASHES_FILE = "file_hashes.json"
+CHARACTER_COUNTS_FILE = "file_characters.json"
+CHARACTER_COUNT_BLOCK_SIZE = 64 * 1024 * 1024
+COMPRESSED_EXTENSIONS = (".xz", ".gz", ".zst")
+# decompressed bytes read by the background thread at once
+DECOMPRESSION_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def is_compressed(file_path):
+    return file_path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def _open_compressed(file_path):
+    if file_path.endswith(".xz"):
+        return lzma.open(file_path, "rb")
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rb")
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"Reading {file_path} requires the `zstandard` package (pip install zstandard).")
+    return zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), read_across_frames=True, closefd=True)
+
+
+class PrefetchingReader(io.RawIOBase):
+    """
+    Binary stream reading chunks of another stream in a background thread. Used for decompression, which releases
+    the GIL, so that it overlaps with the processing of the already decompressed data.
+    """
+
+    def __init__(self, stream, chunk_size=DECOMPRESSION_CHUNK_SIZE, queue_size=4):
+        super().__init__()
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._buffer = memoryview(b"")
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._read_chunks, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _read_chunks(self):
+        try:
+            while not self._stopped.is_set():
+                chunk = self._stream.read(self._chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            # re-raised in the reading thread
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception) or not chunk:
+                # keep signalling the error or the end of the stream to later reads
+                self._chunks.put(chunk)
+                if isinstance(chunk, Exception):
+                    raise chunk
+                return 0
+            self._buffer = memoryview(chunk)
+        n_bytes = min(len(b), len(self._buffer))
+        b[:n_bytes] = self._buffer[:n_bytes]
+        self._buffer = self._buffer[n_bytes:]
+        return n_bytes
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+            self._stream.close()
+        super().close()
+
+
+class PrefetchingIterator:
+    """
+    Iterator over the items of another iterator, produced in a background thread into a bounded queue, so that
+    reading the input overlaps with the processing of the items (e.g. tokenization, which releases the GIL).
+
+    Records how long the consumer waited for items (`wait_time`, high when the input is the bottleneck) and how long
+    the producer waited for space in the queue (`producer_wait_time`, high when the processing is the bottleneck).
+    """
+
+    _END = object()
+
+    def __init__(self, iterator, queue_size=4):
+        self._iterator = iterator
+        self._items = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self.wait_time = 0.
+        self.producer_wait_time = 0.
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                self._items.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.producer_wait_time += time.perf_counter() - start
+
+    def _produce(self):
+        try:
+            for item in self._iterator:
+                if self._stopped.is_set():
+                    return
+                self._put(item)
+            self._put(self._END)
+        except Exception as e:
+            # re-raised in the consuming thread
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self._items.get()
+        self.wait_time += time.perf_counter() - start
+        if item is self._END or isinstance(item, Exception):
+            # keep signalling the end of the items
+            self._items.put(item)
+            if item is self._END:
+                raise StopIteration
+            raise item
+        return item
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_current_rss_mb():
+    """Resident set size of the current process in MB (None where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def get_peak_rss_mb():
+    """Peak resident set size in MB of the current process and of its (finished) child processes, e.g. workers."""
+    import resource
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 2 ** 10
+
+
+def open_text_file(file_path, encoding="utf-8"):
+    """
+    Opens a text file for reading. Files compressed with xz, gzip or zstd (by extension) are decompressed
+    on the fly in a background thread.
+    """
+    if not is_compressed(file_path):
+        return open(file_path, "r", encoding=encoding)
+    return io.TextIOWrapper(io.BufferedReader(PrefetchingReader(_open_compressed(file_path))), encoding=encoding)
+
+
+def get_file_shards(data_path, shard_size=SHARD_SIZE):
+    """Split a file into (start, end) byte ranges aligned to line boundaries.
+    Compressed files cannot be split and are returned as a single shard (0, None)."""
+    if is_compressed(data_path):
+        return [(0, None)]
+    file_size = os.path.getsize(data_path)
+    boundaries = [0]
+    with open(data_path, "rb") as f:
+        while boundaries[-1] + shard_size < file_size:
+            f.seek(boundaries[-1] + shard_size)
+            # move to the beginning of the next line
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            boundaries.append(f.tell())
+    return list(zip(boundaries, boundaries[1:] + [file_size]))
+
+
+def _get_remembered(remember_path, key, compute):
+    """Value remembered in a json file by key, computed and saved if missing."""
+    remembered = {}
+    if os.path.exists(remember_path):
+        with open(remember_path, "r") as f:
+            remembered = json.load(f)
+    if key not in remembered:
+        remembered[key] = compute()
+        with open(remember_path + ".tmp", "w") as f:
+            json.dump(remembered, f, indent=2)
+        os.replace(remember_path + ".tmp", remember_path)
+    return remembered[key]
+
+
+def _get_file_key(data_path):
+    stat = os.stat(data_path)
+    return f"{os.path.abspath(data_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def get_file_hash(data_path, cache_dir, chunk_size=16 * 1024 * 1024):
+    """Hash of the file content. The hashes are remembered in the cache directory by path, size and mtime."""
+    def _hash_file():
+        logging.info(f"Hashing {data_path}")
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(data_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    return _get_remembered(os.path.join(cache_dir, FILE_HASHES_FILE), _get_file_key(data_path), _hash_file)
+
+
+def _count_utf8_characters(data_path, block_size):
+    number_of_characters = 0
+    previous_byte = 0
+
+    def _count_block(block):
+        nonlocal number_of_characters, previous_byte
+        # every code point has exactly one byte that is not a continuation byte (0b10xxxxxx)
+        number_of_characters += len(block) - int(np.count_nonzero((block & 0xC0) == 0x80))
+        # "\r\n" is read as a single "\n" in text mode
+        number_of_characters -= int(np.count_nonzero((block[:-1] == 13) & (block[1:] == 10)))
+        number_of_characters -= int(previous_byte == 13 and block[0] == 10)
+        previous_byte = int(block[-1])
+
+    if is_compressed(data_path):
+        with PrefetchingReader(_open_compressed(data_path)) as f:
+            for chunk in iter(lambda: f.read(block_size), b""):
+                _count_block(np.frombuffer(chunk, dtype=np.uint8))
+        return number_of_characters
+
+    file_size = os.path.getsize(data_path)
+    if file_size == 0:
+        return 0
+    with open(data_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for start in range(0, file_size, block_size):
+            block = np.frombuffer(mapped, dtype=np.uint8, count=min(block_size, file_size - start), offset=start)
+            _count_block(block)
+            # the mapping can only be closed when no array points into it
+            del block
+    return number_of_characters
+
+
+def get_number_of_characters(data_path, cache_dir=None, block_size=CHARACTER_COUNT_BLOCK_SIZE):
+    """
+    Number of characters of a utf-8 text file, as the total length of its lines read in text mode (with universal
+    newlines), counted over the memory-mapped bytes without decoding them.
+    With cache_dir, the counts are remembered in the cache directory by path, size and mtime.
+    """
+    def _count_characters():
+        logging.info(f"Counting characters in {data_path}")
+        return _count_utf8_characters(data_path, block_size)
+
+    if cache_dir is None:
+        return _count_characters()
+    os.makedirs(cache_dir, exist_ok=True)
+    return _get_remembered(os.path.join(cache_dir, CHARACTER_COUNTS_FILE), _get_file_key(data_path),
+                           _count_characters)
+
+
 def get_distributions_over_decoded_vocabulary_default(tokenizer_dir: str, languages: list[str]) -> (
         OrderedDict, OrderedDict):
     """
@@ -47,7 +341,7 @@ def get_distributions_over_decoded_vocabulary_default(tokenizer_dir: str, langua
         tokenizer_stats_path = os.path.join(tokenizer_dir, f"token_freq_{lang}_decoded.json")
 
         try:
-            frequencies_over_vocabulary[lang] = json.load(open(tokenizer_stats_path, 'r'))
+            frequencies_over_vocabulary[lang] = load_token_frequencies(tokenizer_stats_path, decoded=True)
         except FileNotFoundError:
             print(f"{lang} freq file not found ({tokenizer_stats_path}).")
             continue
@@ -56,7 +350,7 @@ def get_distributions_over_decoded_vocabulary_default(tokenizer_dir: str, langua
     tokenizer_stats_path = os.path.join(tokenizer_dir, f"token_frequencies_decoded.json")
 
     try:
-        frequencies_over_vocabulary["All"] = json.load(open(tokenizer_stats_path, 'r'))
+        frequencies_over_vocabulary["All"] = load_token_frequencies(tokenizer_stats_path, decoded=True)
     except FileNotFoundError:
         print(f"Multilingual freq file not found ({tokenizer_stats_path}).")
     
@@ -68,3 +362,12 @@ def get_distributions_over_decoded_vocabulary_default(tokenizer_dir: str, langua
     
     return distribution_over_vocabulary, frequencies_over_vocabulary
 
+
+def get_vocabulary_distributions_default(tokenizer_dir: str, languages: list[str]) -> VocabularyDistributions:
+    """
+    Get the distributions over the vocabulary for each language and "All" (the multilingual frequency file),
+    as a dense matrix aligned by token id. For given tokenizer.
+    """
+    stats_paths = {lang: os.path.join(tokenizer_dir, f"token_freq_{lang}_decoded.json") for lang in languages}
+    stats_paths["All"] = os.path.join(tokenizer_dir, "token_frequencies_decoded.json")
+    return VocabularyDistributions.from_frequency_files(stats_paths)
@@ -0,0 +1,110 @@
+"""
+Word-count index of corpus files: counts of the whitespace-separated words of a file, built once and saved on disk.
+
+For tokenizers that split on whitespace (e.g. SentencePiece with the Metaspace pre-tokenizer), the token frequencies
+of a file are the sum over its unique words of the word count times the word's tokenization, so a new tokenizer
+only needs to tokenize the unique words instead of the running text (see compute_token_frequency.count_words).
+"""
+
+import io
+import logging
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from utils import SHARD_SIZE, get_file_hash, get_file_shards, is_compressed, open_text_file
+
+
+class WordCounts:
+    """Counts of whitespace-separated words, with the number of lines and characters they were counted from."""
+
+    def __init__(self, words=(), counts=(), number_of_lines=0, number_of_characters=0):
+        self.words = list(words)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.number_of_lines = number_of_lines
+        self.number_of_characters = number_of_characters
+
+    @classmethod
+    def from_lines(cls, lines):
+        word_counter = Counter()
+        number_of_lines = 0
+        number_of_characters = 0
+        for line in lines:
+            number_of_lines += 1
+            # characters are counted including the newline character
+            number_of_characters += len(line)
+            word_counter.update(line.split())
+        return cls(word_counter.keys(), list(word_counter.values()), number_of_lines, number_of_characters)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iadd__(self, other):
+        word_counter = Counter(dict(zip(self.words, self.counts.tolist())))
+        word_counter.update(dict(zip(other.words, other.counts.tolist())))
+        self.words = list(word_counter.keys())
+        self.counts = np.array(list(word_counter.values()), dtype=np.int64)
+        self.number_of_lines += other.number_of_lines
+        self.number_of_characters += other.number_of_characters
+        return self
+
+    def save(self, path):
+        # words don't contain whitespace, so they are stored as a single newline-separated utf-8 blob
+        words_blob = np.frombuffer("\n".join(self.words).encode("utf-8"), dtype=np.uint8)
+        with open(path + ".tmp", "wb") as f:
+            np.savez_compressed(f, words=words_blob, counts=self.counts, number_of_lines=self.number_of_lines,
+                                number_of_characters=self.number_of_characters)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            words = saved["words"].tobytes().decode("utf-8").split("\n") if len(saved["counts"]) else []
+            return cls(words, saved["counts"], int(saved["number_of_lines"]), int(saved["number_of_characters"]))
+
+
+def _count_shard_words(shard):
+    data_path, start, end = shard
+    if end is None:
+        with open_text_file(data_path) as f:
+            return WordCounts.from_lines(f)
+    with open(data_path, "rb") as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    # universal newlines, the same as when the whole file is read in text mode
+    return WordCounts.from_lines(io.StringIO(chunk.decode("utf-8"), newline=None))
+
+
+def build_word_counts(data_path, num_workers=1, shard_size=SHARD_SIZE):
+    """Count the words of a file, in line-aligned shards counted by a pool of workers if num_workers > 1."""
+    logging.info(f"Counting words in {data_path}")
+    if num_workers <= 1 or is_compressed(data_path):
+        with open_text_file(data_path) as f:
+            return WordCounts.from_lines(tqdm(f))
+
+    shards = [(data_path, start, end) for start, end in get_file_shards(data_path, shard_size)]
+    word_counter = Counter()
+    number_of_lines = 0
+    number_of_characters = 0
+    with Pool(num_workers) as pool:
+        for shard_word_counts in tqdm(pool.imap_unordered(_count_shard_words, shards), total=len(shards)):
+            word_counter.update(dict(zip(shard_word_counts.words, shard_word_counts.counts.tolist())))
+            number_of_lines += shard_word_counts.number_of_lines
+            number_of_characters += shard_word_counts.number_of_characters
+    return WordCounts(word_counter.keys(), list(word_counter.values()), number_of_lines, number_of_characters)
+
+
+def get_word_counts(data_path, index_dir, num_workers=1):
+    """Load the word counts of a file from the index directory (keyed by the file content), build them if missing."""
+    os.makedirs(index_dir, exist_ok=True)
+    index_path = os.path.join(index_dir, f"{get_file_hash(data_path, index_dir)}_word_counts.npz")
+    if os.path.exists(index_path):
+        logging.info(f"Loading word counts of {data_path} from {index_path}")
+        return WordCounts.load(index_path)
+    word_counts = build_word_counts(data_path, num_workers=num_workers)
+    logging.info(f"Saving {len(word_counts)} word counts of {data_path} to {index_path}")
+    word_counts.save(index_path)
+    return word_counts